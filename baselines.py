@@ -1,5 +1,4 @@
 import sys
-import nltk
 from scipy import sparse as sp
 from text_embedding.documents import *
 from text_embedding.features import *
@@ -10,23 +9,26 @@ from text_embedding.vectors import *
 VECTORFILES[('Amazon', 'GloVe', 1600)] = '/n/fs/nlpdatasets/AmazonProductData/amazon_glove1600.txt'
 
 
-def BonG(n, min_count=1):
+def BonG(n, min_count=1, buckets=None, signed=False):
   prepare = lambda documents: ([True],)
   def represent(documents, vocab):
-    docs = [tokenize(doc.lower() for doc in documents)]
-    for k in range(1, n+1):
-      docs.append([list(nltk.ngrams(doc, k)) for doc in docs[0]])
-      if vocab[0]:
-        vocab.append(sorted({gram for gram, count in feature_counts(docs[k]).items() if count >= min_count}))
+    docs = docs2corpus(documents, lower=True)
+    if not buckets is None:
+      return sp.hstack([hashed_bofs(*ngram_hashes(docs, k), len(docs), buckets, signed) for k in range(1, n+1)], format='csr')
+    if vocab[0]:
+      vocab.append(feature_vocab(docs))
+      vocab.extend(ngram_vocab(docs, k, vocab[1], min_count=min_count) for k in range(1, n+1))
     vocab[0] = False
-    return sp.hstack([docs2bofs(docs[k], vocabulary=vocab[k]) for k in range(1, n+1)], format='csr') 
+    return sp.hstack([ngram_bofs(docs, k, vocab[1], vocab[k+1]) for k in range(1, n+1)], format='csr')
   return represent, prepare, True
 
 
-def SIF(a, vectorfile=None, corpus='Amazon', objective='GloVe', dimension=1600):
-  prepare = lambda documents: (vocab2vecs({word for doc in documents for word in split_on_punctuation(doc.lower())}, vectorfile=vectorfile, corpus=corpus, objective=objective, dimension=dimension), [True, None])
+def SIF(a, vectorfile=None, corpus='Amazon', objective='GloVe', dimension=1600, cache=False, quantize=None):
+  def prepare(documents):
+    vocabulary = {word: i for i, word in enumerate(sorted(docs2corpus(documents, lower=True).words))}
+    return (vocabulary, vocab2mat(vocabulary, vectorfile=vectorfile, corpus=corpus, objective=objective, dimension=dimension, cache=cache, quantize=quantize)), [True, None]
   def represent(documents, w2v, weights):
-    docs = tokenize(doc.lower() for doc in documents)
+    docs = docs2corpus(documents, lower=True)
     if weights[0]:
       weights[0] = False
       weights[1] = sif_weights(docs, a)
@@ -41,6 +43,6 @@ if __name__ == '__main__':
   try:
     represent, prepare, invariant = BonG(int(sys.argv[2]))
   except ValueError:
-    represent, prepare, invariant = SIF(float(sys.argv[2]))
+    represent, prepare, invariant = SIF(float(sys.argv[2]), cache=True)
   for task in sys.argv[1].split(','):
     evaluate(task, represent, prepare=prepare, invariant=invariant, verbose=True, intercept=task in TASKMAP['pairwise task'])
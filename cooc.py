@@ -1,9 +1,23 @@
+import os
 import sys
-import nltk
 import numpy as np
 from numpy.fft import fft
 from numpy.fft import ifft
+from numpy.fft import irfft
+from numpy.fft import rfft
 from scipy import sparse as sp
+try:
+  from numba import config
+  from numba import jit
+  from numba import prange
+  # the default TBB threading layer is not fork-safe, so process pools forked after a kernel has run hang on exit
+  if not 'NUMBA_THREADING_LAYER' in os.environ:
+    config.THREADING_LAYER = 'workqueue'
+  kernel = jit(nopython=True, parallel=True)
+except ImportError:
+  jit = None
+  prange = range
+  kernel = lambda function: function
 from text_embedding.documents import *
 from text_embedding.features import *
 from text_embedding.vectors import *
@@ -11,18 +25,84 @@ from text_embedding.vectors import *
 
 # NOTE: filepath for Amazon GloVe embeddings goes here
 VECTORFILES[('Amazon', 'GloVe', 1600)] = '/n/fs/nlpdatasets/AmazonProductData/amazon_glove1600.txt'
+DISCBLOCK = 2**23
 
 
-def BonC(n, min_count=1):
+@kernel
+def cooc_counts(ids, offsets, k, counts):
+
+  for i in prange(offsets.shape[0]-1):
+    count = 0
+    for start in range(offsets[i], offsets[i+1]-k+1):
+      valid = True
+      for j in range(k):
+        if ids[start+j] < 0:
+          valid = False
+      count += valid
+    counts[i] = count
+
+
+@kernel
+def cooc_fill(ids, offsets, k, base, positions, keys, rows):
+
+  for i in prange(offsets.shape[0]-1):
+    position = positions[i]
+    gram = np.empty(k, dtype=np.int64)
+    for start in range(offsets[i], offsets[i+1]-k+1):
+      valid = True
+      for j in range(k):
+        gram[j] = ids[start+j]
+        if gram[j] < 0:
+          valid = False
+      if valid:
+        gram.sort()
+        key = 0
+        for j in range(k):
+          key = key*base + gram[j]
+        keys[position] = key
+        rows[position] = i
+        position += 1
+
+
+def cooc_keys(corpus, k, vocabulary):
+  '''computes sorted co-occurrence keys with compiled kernels that run in parallel across documents; same output as ngram_keys(corpus, k, vocabulary, unordered=True)
+  Args:
+    corpus: Corpus
+    k: co-occurrence size
+    vocabulary: dict mapping words to indices
+  Returns:
+    (int64 numpy array of keys, int64 numpy array of the document index of each key)
+  '''
+
+  base = max(len(vocabulary), 1)
+  assert base**k <= 2**63, "n-gram keys of a vocabulary this large do not fit in int64"
+  ids = corpus.lookup(vocabulary)[corpus.ids]
+  counts = np.zeros(len(corpus), dtype=np.int64)
+  cooc_counts(ids, corpus.offsets, k, counts)
+  positions = np.concatenate([[0], np.cumsum(counts)])
+  keys = np.empty(positions[-1], dtype=np.int64)
+  rows = np.empty(positions[-1], dtype=np.int64)
+  cooc_fill(ids, corpus.offsets, k, base, positions, keys, rows)
+  return keys, rows
+
+
+def BonC(n, min_count=1, compiled=False):
+  assert not compiled or not jit is None, "compiled kernels require numba"
   prepare = lambda documents: ([True],)
   def represent(documents, vocab):
-    docs = [tokenize(doc.lower() for doc in documents)]
-    for k in range(1, n+1):
-      docs.append([[tuple(sorted(gram)) for gram in nltk.ngrams(doc, k)] for doc in docs[0]])
+    docs = docs2corpus(documents, lower=True)
+    if vocab[0]:
+      vocab.append(feature_vocab(docs))
+    if compiled:
+      grams = [cooc_keys(docs, k, vocab[1]) for k in range(1, n+1)]
       if vocab[0]:
-        vocab.append(sorted({cooc for cooc, count in feature_counts(docs[k]).items() if count >= min_count}))
+        vocab.extend(key_vocab(grams[k-1][0], min_count) for k in range(1, n+1))
+      vocab[0] = False
+      return sp.hstack([key_bofs(*grams[k-1], vocab[k+1], len(docs)) for k in range(1, n+1)], format='csr')
+    if vocab[0]:
+      vocab.extend(ngram_vocab(docs, k, vocab[1], unordered=True, min_count=min_count) for k in range(1, n+1))
     vocab[0] = False
-    return sp.hstack([docs2bofs(docs[k], vocabulary=vocab[k]) for k in range(1, n+1)], format='csr')
+    return sp.hstack([ngram_bofs(docs, k, vocab[1], vocab[k+1], unordered=True) for k in range(1, n+1)], format='csr')
   return represent, prepare, True
 
 
@@ -51,21 +131,158 @@ def circular_conv(cooc, w2v):
   return np.real(ifft(output))
 
 
-def DisC(n, composition, scaling=True, vectorfile=None, corpus='Amazon', objective='GloVe', dimension=1600):
-  prepare = lambda documents: (vocab2vecs({word for doc in documents for word in split_on_punctuation(doc.lower())}, vectorfile=vectorfile, corpus=corpus, objective=objective, dimension=dimension), np.zeros(dimension))
-  compose = {'mult': pointwise_mult, 'conv': circular_conv}[composition]
+def word_rows(corpus, w2v, dimension, dense=False):
+  '''maps the tokens of a Corpus to rows of a matrix holding the vectors of the corpus words
+  Args:
+    corpus: Corpus
+    w2v: dict mapping words to vectors, or tuple (dict mapping words to indices, matrix or QuantizedMatrix)
+    dimension: vector dimension
+    dense: dequantize the rows of the corpus words if the matrix is a QuantizedMatrix; otherwise it is returned as-is, to be dequantized block by block
+  Returns:
+    (int64 numpy array of the row of each token, -1 if its word has no vector; numpy array or QuantizedMatrix whose rows are word vectors)
+  '''
+
+  if type(w2v) == tuple:
+    vocabulary, matrix = w2v
+    index = corpus.lookup(vocabulary)
+    if isinstance(matrix, QuantizedMatrix) and not dense:
+      return index[corpus.ids].astype(np.int64), matrix
+    known = index >= 0
+    used = np.unique(index[known])
+    lookup = np.full(index.shape[0], -1, dtype=np.int64)
+    lookup[known] = np.searchsorted(used, index[known])
+    return lookup[corpus.ids], np.asarray(matrix[used]) if used.shape[0] else np.zeros((0, dimension))
+  words = [word for word in corpus.words if word in w2v]
+  rows = corpus.lookup({word: i for i, word in enumerate(words)})[corpus.ids]
+  return rows, np.vstack([w2v[word] for word in words]) if words else np.zeros((0, dimension))
+
+
+def rfft_rows(matrix, blocksize=BLOCKSIZE):
+  '''computes the real FFT of each row of a matrix, dequantizing one block of rows at a time
+  Args:
+    matrix: numpy array or QuantizedMatrix of size (V, d)
+    blocksize: number of rows per block
+  Returns:
+    complex numpy array of size (V, d//2+1)
+  '''
+
+  if isinstance(matrix, QuantizedMatrix):
+    return np.vstack([rfft(block, axis=1) for _, _, block in matrix.blocks(blocksize)]) if matrix.shape[0] else np.zeros((0, matrix.shape[1]//2+1), dtype=complex)
+  return rfft(matrix, axis=1)
+
+
+def disc_orders(corpus, rows, matrix, n, composition='mult', blocksize=DISCBLOCK, dimension=None):
+  '''sums the compositions of the k-grams of each document for all orders k = 1, ..., n in one pass, gathering the word vectors of a block of documents at a time and extending the products of the (k-1)-grams by one word to get the k-grams
+  Args:
+    corpus: Corpus
+    rows: int numpy array of the row of each token in matrix, -1 if its word has no vector
+    matrix: numpy array or QuantizedMatrix whose rows are word vectors, or numpy array of their real FFTs if composition == 'rfft'
+    n: maximum n-gram length
+    composition: 'mult' (as pointwise_mult), 'conv' (as circular_conv), or 'rfft' (as circular_conv, but multiplying precomputed spectra and summing each document in the frequency domain so there is one inverse transform per document)
+    blocksize: approximate number of vector entries gathered at a time
+    dimension: vector dimension; only needed if composition == 'rfft'
+  Returns:
+    list of n float64 numpy arrays of size (len(corpus), dimension), the k-th holding the k-gram sums; k-grams containing a word without a vector contribute zero
+  '''
+
+  m, d = len(corpus), matrix.shape[1] if dimension is None else dimension
+  outputs = [np.zeros((m, d)) for k in range(n)]
+  if not matrix.shape[0]:
+    return outputs
+  scaling = np.sqrt(d)
+  offsets = corpus.offsets
+  start = 0
+  while start < m:
+    stop = min(m, max(start+1, np.searchsorted(offsets, offsets[start]+max(blocksize//max(d, 1), 1), side='right')-1))
+    first, last = offsets[start], offsets[stop]
+    block = rows[first:last]
+    vectors = matrix[np.maximum(block, 0)]
+    if composition == 'conv':
+      vectors = fft(vectors, axis=1)
+    docs = np.repeat(np.arange(stop-start), np.diff(offsets[start:stop+1]))
+    ends = offsets[start+1:stop+1][docs] - first
+    product = vectors
+    known = block >= 0
+    for k in range(1, n+1):
+      L = block.shape[0] - k + 1
+      if L <= 0:
+        break
+      if k > 1:
+        product = product[:L] * scaling * vectors[k-1:k-1+L] if composition == 'mult' else product[:L] * vectors[k-1:k-1+L]
+        known = known[:L] & (block[k-1:k-1+L] >= 0)
+      valid = known & (np.arange(L) + k <= ends[:L])
+      sums = sp.csr_matrix((np.ones(valid.sum()), (docs[:L][valid], np.flatnonzero(valid))), shape=(stop-start, L)).dot(np.real(ifft(product, axis=1)) if composition == 'conv' else product)
+      outputs[k-1][start:stop] = irfft(sums, n=d, axis=1) if composition == 'rfft' else sums
+    start = stop
+  return outputs
+
+
+@kernel
+def disc_kernel(rows, offsets, matrix, n, scaling, output):
+
+  d = matrix.shape[1]
+  for i in prange(offsets.shape[0]-1):
+    product = np.zeros_like(output[0, 0])
+    for start in range(offsets[i], offsets[i+1]):
+      for k in range(min(n, offsets[i+1]-start)):
+        row = rows[start+k]
+        if row < 0:
+          break
+        for j in range(d):
+          product[j] = matrix[row, j] if k == 0 else product[j] * scaling * matrix[row, j]
+          output[i, k, j] += product[j]
+
+
+def disc_compiled(corpus, rows, matrix, n, composition='mult', dimension=None):
+  '''computes disc_orders with a compiled kernel that runs in parallel across documents and extends each n-gram product one word at a time
+  Args:
+    corpus: Corpus
+    rows: int numpy array of the row of each token in matrix, -1 if its word has no vector
+    matrix: numpy array whose rows are word vectors, or their real FFTs if composition == 'rfft'
+    n: maximum n-gram length
+    composition: 'mult', 'conv', or 'rfft' (see disc_orders); 'conv' is computed as 'rfft' from the real FFTs of the rows of matrix
+    dimension: vector dimension; only needed if composition == 'rfft'
+  Returns:
+    list of n float64 numpy arrays of size (len(corpus), dimension), the k-th holding the k-gram sums
+  '''
+
+  d = matrix.shape[1] if dimension is None else dimension
+  if composition == 'conv':
+    matrix = rfft(matrix, axis=1)
+    composition = 'rfft'
+  if not matrix.shape[0]:
+    return [np.zeros((len(corpus), d)) for k in range(n)]
+  output = np.zeros((len(corpus), n, matrix.shape[1]), dtype=complex if composition == 'rfft' else np.float64)
+  disc_kernel(np.asarray(rows, dtype=np.int64), corpus.offsets, np.ascontiguousarray(matrix), n, 1.0 if composition == 'rfft' else np.sqrt(d), output)
+  if composition == 'rfft':
+    return [irfft(output[:,k], n=d, axis=1) for k in range(n)]
+  return [output[:,k] for k in range(n)]
+
+
+def DisC(n, composition, scaling=True, vectorfile=None, corpus='Amazon', objective='GloVe', dimension=1600, cache=False, quantize=None, spectral=False, compiled=False):
+  assert composition in {'mult', 'conv'}, "composition must be 'mult' or 'conv'"
+  assert not compiled or not jit is None, "compiled kernels require numba"
+  spectral = spectral and composition == 'conv'
+  def prepare(documents):
+    w2v = vocab2vecs(set(docs2corpus(documents, lower=True).words), vectorfile=vectorfile, corpus=corpus, objective=objective, dimension=dimension, cache=cache, quantize=quantize)
+    if spectral:
+      vocabulary, matrix = w2v if type(w2v) == tuple else feature_matrix(w2v)
+      w2v = (vocabulary, rfft_rows(matrix))
+    return w2v, np.zeros(dimension)
   def represent(documents, w2v, z):
-    docs = tokenize(doc.lower() for doc in documents)
+    docs = docs2corpus(documents, lower=True)
+    rows, matrix = word_rows(docs, w2v, z.shape[0], dense=compiled)
+    sums = (disc_compiled if compiled else disc_orders)(docs, rows, matrix, n, 'rfft' if spectral else composition, dimension=z.shape[0])
     if scaling:
-      return np.hstack(np.vstack(sum((compose(gram, w2v) for gram in nltk.ngrams(doc, k)), z) for doc in docs)/k for k in range(1, n+1))
-    return np.hstack(np.vstack(sum((compose(gram, w2v) for gram in nltk.ngrams(doc, k)), z) for doc in docs) for k in range(1, n+1))
+      return np.hstack([sums[k-1]/k for k in range(1, n+1)])
+    return np.hstack(sums)
   return represent, prepare, True
 
 
 if __name__ == '__main__':
 
   try:
-    represent, prepare, invariant = DisC(int(sys.argv[2]), sys.argv[3])
+    represent, prepare, invariant = DisC(int(sys.argv[2]), sys.argv[3], cache=True)
   except IndexError:
     represent, prepare, invariant = BonC(int(sys.argv[2]))
   for task in sys.argv[1].split(','):
@@ -333,7 +333,7 @@ TASKMAP = {'train-test split': {'sst': sst, 'sst_fine': sst_fine, 'imdb': imdb,
 def batched_build(documents, transform, info=(), root='', batchsize=None):
   '''constructs document representations
   Args:
-    documents: list of strings
+    documents: list of strings or Corpus
     transform: function that transforms list of documents to a matrix with len(documents) rows
     info: auxiliary info to pass to transform
     root: root of message to print to StdOut
@@ -347,7 +347,7 @@ def batched_build(documents, transform, info=(), root='', batchsize=None):
       write(root+20*' ')
     return transform(documents, *info)
   offsets = np.arange(0, len(documents), batchsize)
-  return np.vstack(transform(documents[offset:offset+batchsize], *info) for i, offset in enumerate(offsets) if not root or write(root+' Batch '+str(i+1)+'/'+str(len(offsets))+20*' '))
+  return np.vstack([transform(documents[offset:offset+batchsize], *info) for i, offset in enumerate(offsets) if not root or write(root+' Batch '+str(i+1)+'/'+str(len(offsets))+20*' ')])
 
 
 def evaluate(task, represent, prepare=None, batchsize=None, invariant=False, verbose=False, params=[10**i for i in range(-2, 3)], intercept=False, n_folds=2, n_jobs=-1, random_state=0):
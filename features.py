@@ -1,8 +1,15 @@
+from array import array
 from collections import Counter
+import hashlib
 from itertools import chain
 from itertools import groupby
+from itertools import islice
+from multiprocessing import cpu_count
+from multiprocessing import Pool
 from operator import itemgetter
+import re
 #from string import punctuation
+import sys
 from unicodedata import category
 import nltk
 import numpy as np
@@ -12,6 +19,43 @@ from scipy import sparse as sp
 #PUNCTUATION = set(punctuation)
 PUNCTUATION = {'M', 'P', 'S'}
 UINT = np.uint16
+MAXBMP = 0xFFFF
+MASK64 = 2**64-1
+GOLDEN64 = 0x9E3779B97F4A7C15
+TOKEN = None
+
+
+def punctuation_ranges():
+  '''computes codepoint ranges of all mark, punctuation, and symbol characters
+  Returns:
+    list of (first, last) codepoint pairs
+  '''
+
+  ranges = []
+  for code in range(sys.maxunicode+1):
+    if category(chr(code))[0] in PUNCTUATION:
+      if ranges and ranges[-1][1] == code-1:
+        ranges[-1][1] = code
+      else:
+        ranges.append([code, code])
+  return [tuple(r) for r in ranges]
+
+
+def token_patterns():
+  '''compiles (once) regexes matching maximal runs of either punctuation or non-punctuation non-space characters
+  Returns:
+    findall function for documents without non-BMP characters, findall function for all documents
+  '''
+
+  global TOKEN
+  if TOKEN is None:
+    ranges = punctuation_ranges()
+    escape = lambda first, last: re.escape(chr(first)) if first == last else re.escape(chr(first))+'-'+re.escape(chr(last))
+    bmp = ''.join(escape(first, min(last, MAXBMP)) for first, last in ranges if first <= MAXBMP)
+    full = ''.join(escape(first, last) for first, last in ranges)
+    # re checks non-BMP ranges of a character class linearly, so they are only included when needed
+    TOKEN = (re.compile('[^%s\\s]+|[%s]+' % (bmp, bmp)).findall, re.compile('[^%s\\s]+|[%s]+' % (full, full)).findall)
+  return TOKEN
 
 
 def split_on_punctuation(document):
@@ -22,13 +66,23 @@ def split_on_punctuation(document):
     str generator
   '''
 
+  return iter(tokenize_document(document))
+
+
+def reference_split_on_punctuation(document):
+  '''tokenizes string by splitting on spaces and punctuation one character pair at a time; slow reference for split_on_punctuation
+  Args:
+    document: string
+  Returns:
+    str generator
+  '''
+
   for token in document.split():
     if len(token) == 1:
       yield token
     else:
       chunk = token[0]
       for char0, char1 in zip(token[:-1], token[1:]):
-        #if (char0 in PUNCTUATION) == (char1 in PUNCTUATION):
         if (category(char0)[0] in PUNCTUATION) == (category(char1)[0] in PUNCTUATION):
           chunk += char1
         else:
@@ -38,84 +92,615 @@ def split_on_punctuation(document):
         yield chunk
 
 
-def tokenize(documents):
+def tokenize_document(document):
+  '''tokenizes string by splitting on spaces and punctuation
+  Args:
+    document: string
+  Returns:
+    list of strings
+  '''
+
+  bmp, full = token_patterns()
+  if document.isascii() or max(document) <= chr(MAXBMP):
+    return bmp(document)
+  return full(document)
+
+
+def tokenize(documents, n_jobs=1, chunksize=1000):
   '''tokenizes documents
   Args:
     documents: iterable of strings
+    n_jobs: number of worker processes; if -1 uses all CPUs
+    chunksize: number of documents sent to a worker at a time; ignored if n_jobs == 1
   Returns:
     list of list of strings
   '''
 
-  return [list(split_on_punctuation(doc)) for doc in documents]
+  token_patterns()
+  if n_jobs == 1:
+    return [tokenize_document(doc) for doc in documents]
+
+  n_jobs = cpu_count() if n_jobs == -1 else n_jobs
+  pool = Pool(n_jobs)
+  output = pool.map(tokenize_document, documents, chunksize)
+  pool.close()
+  pool.join()
+  return output
+
+
+class Corpus:
+  '''ragged corpus of tokenized documents stored as one flat int32 array of token ids, an array of document offsets, and the list of words indexed by token id (about 4 bytes per token)
+  '''
+
+  def __init__(self, ids, offsets, words):
+    '''initializes object
+    Args:
+      ids: int32 numpy array of the token ids of all documents, concatenated
+      offsets: int64 numpy array of size len(documents)+1; document i has token ids ids[offsets[i]:offsets[i+1]]
+      words: list of strings indexed by token id
+    Returns:
+      None
+    '''
+
+    self.ids = ids
+    self.offsets = offsets
+    self.words = words
+
+  def __len__(self):
+
+    return self.offsets.shape[0]-1
+
+  def __getitem__(self, index):
+    '''gets documents
+    Args:
+      index: int, slice, or int array/list
+    Returns:
+      if index is an int a list of strings; otherwise a Corpus (sharing the token ids if index is a contiguous slice)
+    '''
+
+    if isinstance(index, (int, np.integer)):
+      index = range(len(self))[index]
+      return [self.words[i] for i in self.ids[self.offsets[index]:self.offsets[index+1]]]
+    if type(index) == slice:
+      start, stop, step = index.indices(len(self))
+      if step == 1:
+        stop = max(start, stop)
+        return Corpus(self.ids[self.offsets[start]:self.offsets[stop]], self.offsets[start:stop+1]-self.offsets[start], self.words)
+      index = np.arange(start, stop, step)
+    index = np.arange(len(self))[index]
+    lengths = self.lengths()[index]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    positions = np.repeat(self.offsets[index]-offsets[:-1], lengths) + np.arange(offsets[-1])
+    return Corpus(self.ids[positions], offsets, self.words)
+
+  def __iter__(self):
+
+    for start, stop in zip(self.offsets[:-1], self.offsets[1:]):
+      yield [self.words[i] for i in self.ids[start:stop]]
+
+  def lengths(self):
+    '''returns the number of tokens in each document
+    '''
+
+    return np.diff(self.offsets)
+
+  def rows(self):
+    '''returns the document index of each token
+    '''
+
+    return np.repeat(np.arange(len(self)), self.lengths())
+
+  def counts(self):
+    '''returns the number of occurrences of each token id
+    '''
+
+    return np.bincount(self.ids, minlength=len(self.words))
 
+  def lookup(self, vocabulary):
+    '''maps token ids to indices in a vocabulary
+    Args:
+      vocabulary: dict mapping words to indices
+    Returns:
+      int64 numpy array of size len(words) whose entries are -1 for words not in vocabulary; index with ids to get the vocabulary index of each token
+    '''
 
-def feature_counts(documents):
+    return np.fromiter((vocabulary.get(word, -1) for word in self.words), dtype=np.int64, count=len(self.words))
+
+
+def docs2corpus(documents, lower=False, n_jobs=1):
+  '''builds a Corpus from documents
+  Args:
+    documents: iterable of strings (tokenized by splitting on spaces and punctuation) or of lists of strings; if a Corpus it is returned as-is
+    lower: lowercase string documents before tokenizing
+    n_jobs: number of worker processes used to tokenize string documents; if -1 uses all CPUs
+  Returns:
+    Corpus
+  '''
+
+  if isinstance(documents, Corpus):
+    return documents
+  if lower:
+    documents = (doc.lower() if isinstance(doc, str) else doc for doc in documents)
+  if n_jobs != 1:
+    documents = [doc for doc in documents]
+    strings = [i for i, doc in enumerate(documents) if isinstance(doc, str)]
+    for i, doc in zip(strings, tokenize([documents[i] for i in strings], n_jobs=n_jobs)):
+      documents[i] = doc
+
+  index = {}
+  ids = array('i')
+  lengths = array('q', [0])
+  for doc in documents:
+    if isinstance(doc, str):
+      doc = tokenize_document(doc)
+    ids.extend(index[word] if word in index else index.setdefault(word, len(index)) for word in doc)
+    lengths.append(len(doc))
+  return Corpus(np.array(ids, dtype=np.int32), np.cumsum(np.array(lengths, dtype=np.int64)), list(index))
+
+
+def shard_counts(documents):
+  '''counts the features of one shard of documents
+  Args:
+    documents: list of lists of hashable, picklable features
+  Returns:
+    dict mapping features to counts
+  '''
+
+  return dict(Counter(feat for doc in documents for feat in doc))
+
+
+def feature_counts(documents, n_jobs=1, shardsize=100000):
   '''computes feature counts from featurized documents
   Args:
-    documents: iterable of lists of hashable features
+    documents: iterable (e.g. generator) of lists of hashable features or Corpus
+    n_jobs: number of worker processes that count shards of documents; if -1 uses all CPUs; if not 1 features must be picklable
+    shardsize: number of documents per shard; ignored if n_jobs == 1
   Returns:
     dict mapping features to counts
   '''
 
-  return Counter(feat for doc in documents for feat in doc)
+  if isinstance(documents, Corpus):
+    counts = documents.counts()
+    return Counter({documents.words[i]: int(counts[i]) for i in np.flatnonzero(counts)})
+  if n_jobs == 1:
+    return Counter(feat for doc in documents for feat in doc)
+
+  n_jobs = cpu_count() if n_jobs == -1 else n_jobs
+  documents = iter(documents)
+  shards = iter(lambda: list(islice(documents, shardsize)), [])
+  counts = Counter()
+  pool = Pool(n_jobs)
+  while True:
+    # shards are sent a few at a time so that a streamed corpus is never fully in memory; each shard is merged by key, so a wave costs only its own size
+    wave = list(islice(shards, 2*n_jobs))
+    if not wave:
+      break
+    for shard in pool.map(shard_counts, wave):
+      counts.update(shard)
+  pool.close()
+  pool.join()
+  return counts
 
 
-def feature_vocab(documents, min_count=1, sorted_features=sorted):
+def feature_vocab(documents, min_count=1, sorted_features=sorted, n_jobs=1, sketch=None):
   '''gets feature vocabulary from featurized documents
   Args:
-    documents: iterable of lists of hashable features
+    documents: iterable (e.g. generator) of lists of hashable features or Corpus
     min_count: minimum number of times feature must appear to be included in the vocabulary
     sorted_features: function that sorts the features
+    n_jobs: number of worker processes used by feature_counts; if -1 uses all CPUs
+    sketch: if not None and min_count > 1, counts in two passes with gated_counts using a count-min sketch of this width, which gives the same vocabulary using less memory; documents must then be strings or tuples of strings and iterable twice
   Returns:
     {feature: index} dict
   '''
   
-  return {feat: i for i, feat in enumerate(sorted_features(feat for feat, count in feature_counts(documents).items() if count >= min_count))}
+  if sketch is None or min_count <= 1 or isinstance(documents, Corpus):
+    counts = feature_counts(documents, n_jobs)
+  else:
+    counts = gated_counts(documents, min_count, sketch)
+  return {feat: i for i, feat in enumerate(sorted_features(feat for feat, count in counts.items() if count >= min_count))}
+
 
+def mix64(h):
+  '''splitmix64 finalizer
+  Args:
+    h: int or uint64 numpy array
+  Returns:
+    int in [0, 2**64) or uint64 numpy array
+  '''
 
-def docs2bofs(documents, vocabulary=None, weights=None, default=1.0, format='csr', **kwargs):
+  if type(h) == np.ndarray:
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+  h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+  h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & MASK64
+  return h ^ (h >> 31)
+
+
+def word_hash(word):
+  '''computes a 64-bit string hash that, unlike hash, does not depend on the process
+  Args:
+    word: string
+  Returns:
+    int in [0, 2**64)
+  '''
+
+  return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def hash_feature(feature):
+  '''computes a 64-bit feature hash that, unlike hash, does not depend on the process
+  Args:
+    feature: string or tuple of strings (n-gram); a tuple is hashed by combining the hashes of its words, as in ngram_hashes
+  Returns:
+    int in [0, 2**64)
+  '''
+
+  if type(feature) == tuple:
+    h = word_hash(feature[0])
+    for word in feature[1:]:
+      h = mix64((h * GOLDEN64 + word_hash(word)) & MASK64)
+    return h
+  return word_hash(feature)
+
+
+def ngram_hashes(corpus, n=1):
+  '''computes the feature hashes of the n-grams of each document using a strided window view over the word hashes
+  Args:
+    corpus: Corpus
+    n: n-gram length
+  Returns:
+    (uint64 numpy array of hash_feature of each n-gram tuple (of each word if n == 1), int64 numpy array of the document index of each n-gram)
+  '''
+
+  words = np.fromiter((word_hash(word) for word in corpus.words), dtype=np.uint64, count=len(corpus.words))
+  windows, rows = ngram_windows(corpus, words[corpus.ids], n)
+  hashes = windows[:,0]
+  for j in range(1, n):
+    hashes = mix64(hashes * np.uint64(GOLDEN64) + windows[:,j])
+  return hashes, rows
+
+
+def count_dtype(maxcount, signed=False):
+  '''chooses the smallest integer dtype (of at least 16 bits) that holds counts up to maxcount
+  Args:
+    maxcount: largest absolute count
+    signed: whether counts can be negative
+  Returns:
+    numpy dtype
+  '''
+
+  for dtype in [np.int16, np.int32, np.int64] if signed else [UINT, np.uint32, np.uint64]:
+    if maxcount <= np.iinfo(dtype).max:
+      return dtype
+  raise(OverflowError)
+
+
+def ids2csr(rows, cols, shape, data=None, signed=False, format='csr'):
+  '''constructs a sparse matrix from coordinates by sorting (row, col) keys and summing runs of duplicates
+  Args:
+    rows: int numpy array of row indices
+    cols: int numpy array of column indices
+    shape: (number of rows, number of columns)
+    data: numpy array of values to sum; if None counts coordinates using count_dtype
+    signed: counts may be negative; ignored unless data is an integer array
+    format: sparse matrix format
+  Returns:
+    sparse matrix of size shape
+  '''
+
+  m, n = shape
+  keys = np.asarray(rows, dtype=np.int64) * n + np.asarray(cols, dtype=np.int64)
+  order = np.argsort(keys, kind='stable')
+  keys = keys[order]
+  first = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if keys.shape[0] else np.zeros(0, dtype=np.int64)
+  if data is None:
+    values = np.diff(np.append(first, keys.shape[0]))
+    values = values.astype(count_dtype(values.max() if values.shape[0] else 0))
+  else:
+    data = np.asarray(data)
+    values = np.add.reduceat(data[order], first) if first.shape[0] else data[:0]
+    if data.dtype.kind in 'iu':
+      values = values.astype(count_dtype(np.abs(values).max() if values.shape[0] else 0, signed))
+  indptr = np.concatenate([[0], np.cumsum(np.bincount(keys[first] // max(n, 1), minlength=m))])
+  return sp.csr_matrix((values, keys[first] % max(n, 1), indptr), shape=shape).asformat(format)
+
+
+class CountMinSketch:
+  '''count-min sketch of 64-bit feature hashes; estimates never undercount and, with probability at least 1-exp(-depth), overcount by at most e*(total count)/width
+  '''
+
+  def __init__(self, width=2**20, depth=4, seed=0):
+    '''initializes object
+    Args:
+      width: number of counters per row
+      depth: number of rows (independent hash functions)
+      seed: hash seed
+    Returns:
+      None
+    '''
+
+    self.width = width
+    self.depth = depth
+    self.seeds = mix64(np.arange(1, depth+1, dtype=np.uint64) + np.uint64(seed))
+    self.table = np.zeros((depth, width), dtype=np.uint32)
+
+  def positions(self, hashes, row):
+    '''computes the counter of each hash in one row
+    Args:
+      hashes: uint64 numpy array
+      row: row index
+    Returns:
+      int64 numpy array
+    '''
+
+    return (mix64(hashes ^ self.seeds[row]) % np.uint64(self.width)).astype(np.int64)
+
+  def add(self, hashes, counts=None):
+    '''counts occurrences of hashes
+    Args:
+      hashes: uint64 numpy array
+      counts: int numpy array of the number of occurrences of each hash; if None counts one occurrence of each
+    Returns:
+      None
+    '''
+
+    for row in range(self.depth):
+      # counters saturate instead of wrapping around
+      self.table[row] = np.minimum(self.table[row] + np.bincount(self.positions(hashes, row), weights=counts, minlength=self.width), 2**32-1)
+
+  def query(self, hashes):
+    '''estimates counts
+    Args:
+      hashes: uint64 numpy array
+    Returns:
+      uint32 numpy array of upper bounds on the number of times each hash was added
+    '''
+
+    return np.min([self.table[row][self.positions(hashes, row)] for row in range(self.depth)], axis=0)
+
+
+def gated_counts(documents, min_count, width=2**20, depth=4, shardsize=1000):
+  '''computes exact counts of all features that appear at least min_count times, using a first pass into a CountMinSketch to keep rarer features out of the counter
+  Args:
+    documents: iterable of lists of strings or tuples of strings that can be iterated twice (e.g. a list)
+    min_count: minimum number of times feature must appear to be counted
+    width: sketch width
+    depth: sketch depth
+    shardsize: number of documents hashed at a time
+  Returns:
+    dict mapping features to counts; contains every feature with count >= min_count and a subset of the rest
+  '''
+
+  assert not iter(documents) is documents, "two-pass counting requires documents that can be iterated twice"
+  # each shard is counted exactly first, so every distinct feature of a shard is hashed once
+  sketch = CountMinSketch(width, depth)
+  docs = iter(documents)
+  for shard in iter(lambda: list(islice(docs, shardsize)), []):
+    shard = Counter(feat for doc in shard for feat in doc)
+    sketch.add(np.fromiter(map(hash_feature, shard), dtype=np.uint64, count=len(shard)), np.fromiter(shard.values(), dtype=np.float64, count=len(shard)))
+  counts = Counter()
+  docs = iter(documents)
+  for shard in iter(lambda: list(islice(docs, shardsize)), []):
+    shard = Counter(feat for doc in shard for feat in doc)
+    admit = sketch.query(np.fromiter(map(hash_feature, shard), dtype=np.uint64, count=len(shard))) >= min_count
+    counts.update({feat: count for (feat, count), keep in zip(shard.items(), admit) if keep})
+  return counts
+
+
+def hashed_bofs(hashes, rows, m, buckets, signed=False, data=None, format='csr'):
+  '''constructs sparse BoF representations by hashing features into buckets
+  Args:
+    hashes: uint64 numpy array of feature hashes
+    rows: nondecreasing int numpy array of the document index of each hash
+    m: number of documents
+    buckets: number of columns
+    signed: multiply each feature by a sign taken from the top bit of its hash so that collisions cancel in expectation
+    data: numpy array of feature weights; if None counts features
+    format: sparse matrix format
+  Returns:
+    sparse BoF matrix of size (m, buckets)
+  '''
+
+  cols = (hashes % np.uint64(buckets)).astype(np.int64)
+  if signed:
+    data = np.ones(hashes.shape[0], dtype=np.int64) if data is None else data
+    data = np.where(hashes >> np.uint64(63), -data, data)
+  bofs = ids2csr(rows, cols, (m, buckets), data, signed, format='csr')
+  if signed:
+    bofs.eliminate_zeros()
+  return bofs.asformat(format)
+
+
+def docs2bofs(documents, vocabulary=None, weights=None, default=1.0, format='csr', buckets=None, signed=False, **kwargs):
   '''constructs sparse BoF representations from featurized documents
   Args:
-    documents: iterable of lists of hashable features
-    vocabulary: dict mapping features to indices (nonnegative ints) or a list of features; if None will compute automatically from documents
-    weights: dict mapping features to weights (floats) or a list/np.ndarray of weights; if None will compute unweighted BoFs
+    documents: iterable of lists of hashable features or Corpus
+    vocabulary: dict mapping features to indices (nonnegative ints) or a list of features; if None will compute automatically from documents; ignored if not buckets is None
+    weights: dict mapping features to weights (floats) or a list/np.ndarray of weights (of length buckets if hashing); if None will compute unweighted BoFs
     default: default feature weight if not feature in weights; ignored if weights is None
     format: sparse matrix format
+    buckets: if not None, hashes features (strings or tuples of strings) into this many columns instead of using a vocabulary
+    signed: use signed feature hashing; ignored if buckets is None
     kwargs: passed to feature_vocab; ignored if not vocabulary is None
   Returns:
-    sparse BoF matrix in CSR format of size (len(documents), len(vocabulary))
+    sparse BoF matrix in CSR format of size (len(documents), len(vocabulary)), or (len(documents), buckets) if hashing
   '''
 
+  if not isinstance(documents, Corpus) and not type(documents) == list:
+    documents = list(documents)
+  if not buckets is None:
+    if isinstance(documents, Corpus):
+      hashes, rows = ngram_hashes(documents)
+      feats = None if type(weights) == dict else []
+    else:
+      feats = [feat for doc in documents for feat in doc]
+      hashes = np.fromiter((hash_feature(feat) for feat in feats), dtype=np.uint64, count=len(feats))
+      rows = np.repeat(np.arange(len(documents)), [len(doc) for doc in documents])
+    if type(weights) == dict:
+      if feats is None:
+        data = np.array([weights.get(word, default) for word in documents.words])[documents.ids]
+      else:
+        data = np.array([weights.get(feat, default) for feat in feats], dtype=np.float64)
+      return hashed_bofs(hashes, rows, len(documents), buckets, signed, data, format)
+    bofs = hashed_bofs(hashes, rows, len(documents), buckets, signed, format='csr')
+    if weights is None:
+      return bofs.asformat(format)
+    assert len(weights) == buckets, "if weights passed as a list/np.ndarray when hashing, length must be same as the number of buckets"
+    return bofs.dot(sp.diags(np.asarray(weights, dtype=np.float64), 0)).asformat(format)
+
   if vocabulary is None:
     vocabulary = feature_vocab(documents, **kwargs)
   elif type(vocabulary) == list:
     vocabulary = {feat: i for i, feat in enumerate(vocabulary)}
 
-  rows, cols, values = zip(*((row, col, count) for (row, col), count in Counter((i, vocabulary.get(feat, -1)) for i, doc in enumerate(documents) for feat in doc).items() if not col==-1))
+  if isinstance(documents, Corpus):
+    cols = documents.lookup(vocabulary)[documents.ids]
+    lengths = documents.lengths()
+  else:
+    cols = np.fromiter((vocabulary.get(feat, -1) for doc in documents for feat in doc), dtype=np.int64)
+    lengths = np.fromiter((len(doc) for doc in documents), dtype=np.int64, count=len(documents))
+  known = cols >= 0
   m = len(documents)
   V = len(vocabulary)
+  bofs = ids2csr(np.repeat(np.arange(m), lengths)[known], cols[known], (m, V), format='csr')
   if weights is None:
-    return sp.coo_matrix((values, (rows, cols)), shape=(m, V), dtype=UINT).asformat(format)
-  bofs = sp.coo_matrix((values, (rows, cols)), shape=(m, V)).tocsr()
+    return bofs.asformat(format)
 
   if type(weights) == dict:
     diag = np.empty(V)
     for feat, i in vocabulary.items():
-      diag[i] = weights.gets(feat, default)
+      diag[i] = weights.get(feat, default)
   else:
     assert len(weights) == V, "if weights passed as a list/np.ndarray, length must be same as vocabulary size"
-    if type(weights) == list:
-      diag = np.array(weights)
-    else:
-      diag = weights
-  return bofs.dot(sp.diags(diag, 0)).asformat(format)
+    diag = np.asarray(weights, dtype=np.float64)
+  return sp.csr_matrix((bofs.data * diag[bofs.indices], bofs.indices, bofs.indptr), shape=bofs.shape).asformat(format)
+
+
+def ngram_windows(corpus, values, n):
+  '''gets strided windows over per-token values that do not cross document boundaries
+  Args:
+    corpus: Corpus
+    values: numpy array with one entry per token of corpus
+    n: window length
+  Returns:
+    (numpy array of size (number of n-grams, n), int64 numpy array of the document index of each n-gram)
+  '''
+
+  if values.shape[0] < n:
+    return np.zeros((0, n), dtype=values.dtype), np.zeros(0, dtype=np.int64)
+  windows = np.lib.stride_tricks.sliding_window_view(values, n)
+  rows = corpus.rows()[:windows.shape[0]]
+  valid = np.arange(windows.shape[0]) + n <= corpus.offsets[1:][rows]
+  return windows[valid], rows[valid]
+
+
+def ngram_keys(corpus, n, vocabulary=None, unordered=False):
+  '''packs the n-grams of each document into int64 keys using a strided window view over the token ids
+  Args:
+    corpus: Corpus
+    n: n-gram length
+    vocabulary: dict mapping words to indices, used as the digits of the keys; if None uses the sorted words of corpus
+    unordered: sort the word indices within each n-gram, so that keys identify unordered co-occurrences
+  Returns:
+    (int64 numpy array of keys, int64 numpy array of the document index of each key); n-grams containing words not in vocabulary are dropped; if vocabulary indices follow sorted word order then sorted keys follow sorted n-gram tuples
+  '''
+
+  if vocabulary is None:
+    vocabulary = {word: i for i, word in enumerate(sorted(corpus.words))}
+  base = max(len(vocabulary), 1)
+  assert base**n <= 2**63, "n-gram keys of a vocabulary this large do not fit in int64"
+  windows, rows = ngram_windows(corpus, corpus.lookup(vocabulary)[corpus.ids], n)
+  valid = windows.min(1) >= 0 if windows.shape[0] else np.zeros(0, dtype=bool)
+  windows = windows[valid]
+  if unordered:
+    windows = np.sort(windows, axis=1)
+  return windows.dot(base ** np.arange(n-1, -1, -1, dtype=np.int64)), rows[valid]
+
+
+def key_vocab(grams, min_count=1):
+  '''gets the vocabulary of packed n-gram keys
+  Args:
+    grams: int64 numpy array of the key of each n-gram occurrence, e.g. output of ngram_keys
+    min_count: minimum number of times key must appear to be included in the vocabulary
+  Returns:
+    sorted int64 numpy array of keys
+  '''
+
+  keys, counts = np.unique(grams, return_counts=True)
+  return keys[counts >= min_count]
+
+
+def key_bofs(grams, rows, keys, m, format='csr'):
+  '''constructs sparse bag-of-n-grams representations from packed n-gram keys
+  Args:
+    grams: int64 numpy array of the key of each n-gram occurrence
+    rows: int numpy array of the document index of each n-gram occurrence
+    keys: sorted int64 numpy array of vocabulary keys, e.g. output of key_vocab
+    m: number of documents
+    format: sparse matrix format
+  Returns:
+    sparse BoF matrix of size (m, len(keys))
+  '''
+
+  cols = np.minimum(np.searchsorted(keys, grams), max(keys.shape[0]-1, 0))
+  known = keys[cols] == grams if keys.shape[0] else np.zeros(grams.shape[0], dtype=bool)
+  return ids2csr(rows[known], cols[known], (m, keys.shape[0]), format=format)
+
+
+def ngram_vocab(corpus, n, vocabulary=None, unordered=False, min_count=1):
+  '''gets n-gram vocabulary of a Corpus as sorted packed keys
+  Args:
+    corpus: Corpus
+    n: n-gram length
+    vocabulary: dict mapping words to indices; if None uses the sorted words of corpus
+    unordered: count unordered co-occurrences instead of n-grams
+    min_count: minimum number of times n-gram must appear to be included in the vocabulary
+  Returns:
+    sorted int64 numpy array of n-gram keys
+  '''
+
+  return key_vocab(ngram_keys(corpus, n, vocabulary, unordered)[0], min_count)
+
+
+def ngram_bofs(corpus, n, vocabulary, keys, unordered=False, format='csr'):
+  '''constructs sparse bag-of-n-grams representations of a Corpus
+  Args:
+    corpus: Corpus
+    n: n-gram length
+    vocabulary: dict mapping words to indices that was used to compute keys
+    keys: sorted int64 numpy array of n-gram keys, e.g. output of ngram_vocab
+    unordered: count unordered co-occurrences instead of n-grams
+    format: sparse matrix format
+  Returns:
+    sparse BoF matrix of size (len(corpus), len(keys))
+  '''
+
+  return key_bofs(*ngram_keys(corpus, n, vocabulary, unordered), keys, len(corpus), format)
+
+
+def ngram_tuples(keys, n, words):
+  '''unpacks n-gram keys
+  Args:
+    keys: int64 numpy array of n-gram keys
+    n: n-gram length
+    words: list of words indexed like the vocabulary used to compute keys
+  Returns:
+    list of tuples of words
+  '''
+
+  base = max(len(words), 1)
+  digits = (keys[:,None] // base ** np.arange(n-1, -1, -1, dtype=np.int64)) % base
+  return [tuple(words[i] for i in gram) for gram in digits]
 
 
-def sif_weights(documents_or_counts, a=1E-2):
+def sif_weights(documents_or_counts, a=1E-2, n_jobs=1):
   '''computes SIF weights from featurized documents
   Args:
-    documents_or_counts: iterable of lists of hashable features or dict mapping features to counts or count vector
+    documents_or_counts: iterable (e.g. generator) of lists of hashable features, Corpus, or dict mapping features to counts or count vector
     a: SIF parameter
+    n_jobs: number of worker processes used by feature_counts if passed documents; if -1 uses all CPUs
   Returns:
     if passed documents of count dict: dict mapping features to weights (floats); else a weight vector
   '''
@@ -123,7 +708,7 @@ def sif_weights(documents_or_counts, a=1E-2):
   if type(documents_or_counts) == np.ndarray:
     axtotal = a*sum(documents_or_counts)
     return axtotal/(axtotal+documents_or_counts) 
-  if type(documents_or_counts) == list:
-    documents_or_counts = feature_counts(documents_or_counts)
+  if not isinstance(documents_or_counts, dict):
+    documents_or_counts = feature_counts(documents_or_counts, n_jobs)
   axtotal = a*sum(documents_or_counts.values())
   return {feat: axtotal/(axtotal+count) for feat, count in documents_or_counts.items()}
@@ -0,0 +1,41 @@
+"""Tests for text_embedding.features tokenization."""
+
+import sys
+import unittest
+
+from text_embedding import documents
+from text_embedding.features import reference_split_on_punctuation
+from text_embedding.features import tokenize
+from text_embedding.features import tokenize_document
+
+
+class TokenizeTest(unittest.TestCase):
+
+  def assertTokenizedLikeReference(self, texts):
+    for text, tokens in zip(texts, tokenize(texts)):
+      self.assertEqual(tokens, list(reference_split_on_punctuation(text)), msg=repr(text))
+
+  def testAllCodepoints(self):
+    # each codepoint is checked alone and next to a letter and a punctuation mark, covering both regexes
+    codepoints = [chr(code) for code in range(sys.maxunicode+1)]
+    self.assertTokenizedLikeReference(codepoints)
+    self.assertTokenizedLikeReference(['a'+char+'a' for char in codepoints])
+    self.assertTokenizedLikeReference(['.'+char+'.' for char in codepoints])
+
+  def testMixedDocuments(self):
+    self.assertTokenizedLikeReference(['', ' ', "don't stop--ever!", 'áb c.́', 'x\U0001F600y \U0001F600\U0001F601!', 'tab\there\nnewline'])
+
+  def testDatasets(self):
+    for load in [documents.sst, documents.sst_fine, documents.trec]:
+      for texts, _ in load():
+        self.assertTokenizedLikeReference(texts)
+    for load in [documents.mr, documents.cr, documents.subj, documents.mpqa]:
+      self.assertTokenizedLikeReference(load()[0])
+
+  def testParallel(self):
+    texts = documents.sst('test')[0]
+    self.assertEqual(tokenize(texts, n_jobs=2, chunksize=100), [tokenize_document(text) for text in texts])
+
+
+if __name__ == "__main__":
+  unittest.main()
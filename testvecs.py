@@ -8,11 +8,15 @@ from text_embedding.vectors import *
 
 
 def unigram_baseline(w2v, task, n_jobs=-1):
-  z = np.zeros(w2v[next(iter(w2v))].shape[0])
-  rep = lambda docs: np.vstack(sum((w2v.get(w, z) for w in split_on_punctuation(doc.lower())), z) for doc in docs)
+  rep = lambda docs: docs2vecs(tokenize(doc.lower() for doc in docs), f2v=w2v)
   return evaluate(task.lower(), rep, invariant=True, params=[10**i for i in range(-4, 5)], n_jobs=n_jobs)
 
 
+def quantization_delta(vocabulary, quantized, task, baseline, n_jobs=-1):
+  quantized = unigram_baseline((vocabulary, quantized), task, n_jobs=n_jobs)[1]
+  return baseline, quantized, quantized-baseline
+
+
 @align_vocab
 def linear_alignment(source, target, orthogonal=True, fit_intercept=False):
   M, b = best_transform(source, target, orthogonal=orthogonal, fit_intercept=fit_intercept)
@@ -24,6 +28,7 @@ def parse():
   parser.add_argument('vectorfiles', nargs='+', help='one or two word embedding text files (space-separated)')
   parser.add_argument('-d', '--dimension', default=None, help='embedding dimension (defaults to using entire row)', type=int)
   parser.add_argument('-t', '--tasks', nargs='*', help='embedding evaluation tasks (space-separated)')
+  parser.add_argument('-q', '--quantize', nargs='*', choices=['float16', 'int8', 'pq'], help='also report accuracy change when quantizing embeddings to these types (space-separated)')
   return parser.parse_args()
 
 
@@ -37,30 +42,46 @@ if __name__ == '__main__':
     write('Loading Word Embeddings')
     w2v = vocab2vecs(vectorfile=files[0], dimension=d)
     tasks = args.tasks if args.tasks else ['SST', 'IMDB']
+    if args.quantize:
+      vocabulary, matrix = w2v = feature_matrix(w2v)
 
     write('\rClassification Evaluation: Test Accuracy using Logit over Sum-of-Embeddings\n')
+    accuracies = {}
     for task in tasks:
       write(task+' Acc: ')
-      write(str(unigram_baseline(w2v, task.lower())[1]) + '\n')
+      accuracies[task] = unigram_baseline(w2v, task.lower())[1]
+      write(str(accuracies[task]) + '\n')
+
+    for quantize in args.quantize if args.quantize else []:
+      write('\rQuantization Evaluation: Change in Test Accuracy using '+quantize+' Embeddings\n')
+      quantized = quantize_matrix(matrix, quantize)
+      for task in tasks:
+        write(task+' Acc Delta: ')
+        write(str(quantization_delta(vocabulary, quantized, task.lower(), accuracies[task])[2]) + '\n')
 
   else:
     write('Loading Source Embeddings')
-    src = vocab2vecs(vectorfile=files[0], dimension=d, unit=False)
+    words, vectors = load_matrix(files[0], dimension=d)
+    src = ({word: i for i, word in enumerate(words)}, vectors)
     write('\rLoading Target Embeddings')
-    tgt = vocab2vecs(vectorfile=files[1], dimension=d, unit=False)
+    words, vectors = load_matrix(files[1], dimension=d)
+    tgt = ({word: i for i, word in enumerate(words)}, vectors)
+
+    write('\rAligning Source and Target Vocabularies')
+    pair = AlignedPair(src, tgt)
 
     write('\rAlignment Evaluation: Mean Cosine Similarity of Best Orthogonal Transform\n')
     write('Avg Sim: ')
-    write(str(linear_alignment(src, tgt, orthogonal=True, fit_intercept=False)) + '\n')
+    write(str(linear_alignment(*pair, orthogonal=True, fit_intercept=False)) + '\n')
 
     write('\rAlignment Evaluation: Mean Cosine Similarity of Best Orthogonal Transform with Translation\n')
     write('Avg Sim: ')
-    write(str(linear_alignment(src, tgt, orthogonal=True, fit_intercept=True)) + '\n')
+    write(str(linear_alignment(*pair, orthogonal=True, fit_intercept=True)) + '\n')
 
     write('\rAlignment Evaluation: Mean Cosine Similarity of Best Linear Transform\n')
     write('Avg Sim: ')
-    write(str(linear_alignment(src, tgt, orthogonal=False, fit_intercept=False)) + '\n')
+    write(str(linear_alignment(*pair, orthogonal=False, fit_intercept=False)) + '\n')
 
     write('\rAlignment Evaluation: Mean Cosine Similarity of Best Linear Transform with Translation\n')
     write('Avg Sim: ')
-    write(str(linear_alignment(src, tgt, orthogonal=False, fit_intercept=True)) + '\n')
+    write(str(linear_alignment(*pair, orthogonal=False, fit_intercept=True)) + '\n')
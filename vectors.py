@@ -1,70 +1,783 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from bisect import bisect_right
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import h5py
 import numpy as np
 from numpy.linalg import norm
+from scipy import sparse as sp
+from scipy.linalg import lstsq
 from scipy.linalg import svd
+from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import normalize
+from text_embedding.features import Corpus
+from text_embedding.features import GOLDEN64
+from text_embedding.features import MASK64
+from text_embedding.features import mix64
+from text_embedding.features import word_hash
 
 
 FLOAT = np.float32
+BLOCKSIZE = 2**14
 # NOTE: filepath for Common Crawl GloVe embeddings goes here
 VECTORFILES = {('CC', 'GloVe', 300): '/n/fs/nlpdatasets/glove.840B/glove.840B.300d.txt'}
+# NOTE: directory and size cap (in bytes) of the on-disk cache of loaded embedding subsets
+CACHEDIR = os.path.join(os.path.expanduser('~'), '.cache', 'text_embedding')
+CACHESIZE = 16*2**30
 
 
-# NOTE: Some files have 2d or 2d+2 numbers on each line, with the last d of them being meaningless; avoid loading them by setting dimension=d
-def load(vectorfile, vocabulary=None, dimension=None):
-  '''generates word embeddings from file
+class SortedWords:
+  '''read-only sequence of words in sorted order, backed by a word list and an argsort index; supports bisect
+  '''
+
+  def __init__(self, words, index):
+    '''initializes object
+    Args:
+      words: list of strings
+      index: int array such that words[index[i]] is the i-th smallest word
+    Returns:
+      None
+    '''
+
+    self.words = words
+    self.index = index
+
+  def __len__(self):
+
+    return len(self.index)
+
+  def __getitem__(self, i):
+
+    return self.words[self.index[i]]
+
+
+def txt2mmap(vectorfile, mmapdir, dimension=None):
+  '''converts word embedding text file to a directory that can be memory-mapped by load, vocab2mat, and vocab2vecs
   Args:
-    vectorfile: word embedding text file or HDF5 file with keys 'words' and 'vectors'
-    vocabulary: dict/set of strings, or int specifying number of words to load; if None loads all words from file
+    vectorfile: word embedding text file
+    mmapdir: output directory; will contain float32 matrix 'vectors.npy', words in file order 'words.txt', and argsort of the words 'index.npy'
+    dimension: number of dimensions to store; if None stores entire row
+  Returns:
+    None
+  '''
+
+  with open(vectorfile, 'r') as f:
+    line = f.readline()
+    d = len(line.split()[1:][:dimension])
+    V = 1 + sum(1 for line in f)
+
+  if not os.path.isdir(mmapdir):
+    os.makedirs(mmapdir)
+  vectors = np.lib.format.open_memmap(os.path.join(mmapdir, 'vectors.npy'), mode='w+', dtype=FLOAT, shape=(V, d))
+  words = []
+  for i, (word, vector) in enumerate(load(vectorfile, dimension=dimension)):
+    vectors[i] = vector
+    words.append(word)
+  vectors.flush()
+  del vectors
+
+  with open(os.path.join(mmapdir, 'words.txt'), 'w') as f:
+    f.write('\n'.join(words))
+  np.save(os.path.join(mmapdir, 'index.npy'), np.array(sorted(range(V), key=words.__getitem__), dtype=np.int64))
+
+
+def mmap_load(mmapdir, vocabulary=None, dimension=None):
+  '''loads word embeddings from a directory written by txt2mmap without parsing any numbers
+  Args:
+    mmapdir: directory written by txt2mmap
+    vocabulary: iterable of strings, or int specifying number of words to load; if None loads all words
     dimension: number of dimensions to load
   Returns:
-    (word, vector) generator
+    (list of words, numpy array of size (len(words), dimension)); if vocabulary is None or an int the array is a memory-mapped view of the file
   '''
 
-  try:
-    f = h5py.File(vectorfile, 'r')
-    for word, vector in zip(f['words'], f['vectors']):
-      if vocabulary is None or word in vocabulary:
-        yield word, vector
-    f.close()
+  vectors = np.load(os.path.join(mmapdir, 'vectors.npy'), mmap_mode='r')
+  with open(os.path.join(mmapdir, 'words.txt'), 'r') as f:
+    words = f.read().split('\n')[:vectors.shape[0]]
 
-  except OSError:
+  if vocabulary is None:
+    return words, vectors[:,:dimension]
+  if type(vocabulary) == int:
+    return words[:vocabulary], vectors[:vocabulary,:dimension]
+
+  # duplicate words are resolved to their last occurrence, as in hdf5_load, parallel_load, and load with last=True
+  view = SortedWords(words, np.load(os.path.join(mmapdir, 'index.npy'), mmap_mode='r'))
+  rows = []
+  for word in vocabulary:
+    i = bisect_right(view, word) - 1
+    if i >= 0 and view[i] == word:
+      rows.append(view.index[i])
+  rows = np.sort(np.array(rows, dtype=np.int64))
+  return [words[i] for i in rows], vectors[rows,:dimension]
+
+
+def txt2hdf5(vectorfile, hdf5file, dimension=None, chunkrows=None):
+  '''converts word embedding text file to an indexed HDF5 file that can be read by load, vocab2mat, and vocab2vecs
+  Args:
+    vectorfile: word embedding text file
+    hdf5file: output HDF5 file; will contain words in file order 'words', chunked float32 matrix 'vectors', and argsort of the words 'index'
+    dimension: number of dimensions to store; if None stores entire row
+    chunkrows: number of rows per HDF5 chunk; if None uses chunks of about 1MB
+  Returns:
+    None
+  '''
+
+  with open(vectorfile, 'r') as f:
+    line = f.readline()
+    d = len(line.split()[1:][:dimension])
+    V = 1 + sum(1 for line in f)
+  chunkrows = min(V, max(1, 2**20 // (4*d)) if chunkrows is None else chunkrows)
+
+  f = h5py.File(hdf5file, 'w')
+  vectors = f.create_dataset('vectors', shape=(V, d), dtype=FLOAT, chunks=(chunkrows, d))
+  words = []
+  block = np.empty((chunkrows, d), dtype=FLOAT)
+  for i, (word, vector) in enumerate(load(vectorfile, dimension=dimension)):
+    words.append(word)
+    block[i % chunkrows] = vector
+    if (i+1) % chunkrows == 0:
+      vectors[i+1-chunkrows:i+1] = block
+  if V % chunkrows:
+    vectors[V - V%chunkrows:] = block[:V%chunkrows]
+  f.create_dataset('words', data=words, dtype=h5py.string_dtype('utf-8'))
+  f.create_dataset('index', data=np.array(sorted(range(V), key=words.__getitem__), dtype=np.int64))
+  f.close()
+
+
+def hdf5_load(hdf5file, vocabulary=None, dimension=None):
+  '''loads word embeddings from HDF5 file using one bulk read per chunk of the 'vectors' dataset
+  Args:
+    hdf5file: HDF5 file with keys 'words' and 'vectors' and optionally 'index' (as written by txt2hdf5)
+    vocabulary: iterable of strings, or int specifying number of words to load; if None loads all words
+    dimension: number of dimensions to load
+  Returns:
+    (list of words, numpy array of size (len(words), dimension))
+  '''
+
+  with h5py.File(hdf5file, 'r') as f:
+    words = [word.decode('utf-8') if type(word) == bytes else word for word in f['words'][:]]
+    vectors = f['vectors']
     if vocabulary is None:
-      V = float('inf')
-    elif type(vocabulary) == int:
-      V = vocabulary
+      return words, vectors[:,:dimension]
+    if type(vocabulary) == int:
+      return words[:vocabulary], vectors[:vocabulary,:dimension]
+
+    if 'index' in f:
+      view = SortedWords(words, f['index'][:])
+      rows = []
+      for word in vocabulary:
+        i = bisect_right(view, word) - 1
+        if i >= 0 and view[i] == word:
+          rows.append(view.index[i])
+    else:
+      w2r = {word: i for i, word in enumerate(words)}
+      rows = [w2r[word] for word in vocabulary if word in w2r]
+    rows = np.sort(np.array(rows, dtype=np.int64))
+
+    chunkrows = vectors.shape[0] if vectors.chunks is None else vectors.chunks[0]
+    output = np.empty((rows.shape[0], vectors.shape[1] if dimension is None else min(dimension, vectors.shape[1])), dtype=vectors.dtype)
+    bounds = np.searchsorted(rows, np.arange(0, vectors.shape[0]+chunkrows, chunkrows))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+      if stop > start:
+        offset = rows[start] - rows[start] % chunkrows
+        output[start:stop] = vectors[offset:rows[stop-1]+1,:dimension][rows[start:stop]-offset]
+    return [words[i] for i in rows], output
+
+
+def parse_chunk(args):
+  '''parses the lines of a text embedding file lying in a byte range
+  Args:
+    args: tuple (vectorfile, start, stop, vocabulary, dimension); start and stop must be aligned to the start of a line
+  Returns:
+    (list of words, numpy array of size (len(words), dimension))
+  '''
+
+  vectorfile, start, stop, vocabulary, dimension = args
+  with open(vectorfile, 'rb') as f:
+    f.seek(start)
+    lines = f.read(stop-start).decode('utf-8').split('\n')
+
+  words, entries = [], []
+  for line in lines:
+    index = line.find(' ')
+    if index > 0:
+      word = line[:index]
+      if vocabulary is None or word in vocabulary:
+        words.append(word)
+        entries.append(line[index+1:])
+  if not words:
+    return words, np.empty((0, 0 if dimension is None else dimension), dtype=FLOAT)
+
+  values = np.fromstring(' '.join(entries), dtype=FLOAT, sep=' ')
+  ncols = len(entries[0].split())
+  if values.shape[0] == len(words)*ncols:
+    return words, values.reshape(len(words), ncols)[:,:dimension]
+  return words, np.vstack([np.fromstring(entry, dtype=FLOAT, sep=' ')[:dimension] for entry in entries])
+
+
+def parallel_load(vectorfile, vocabulary=None, dimension=None, n_jobs=-1):
+  '''loads word embeddings from text file by parsing newline-aligned byte ranges in worker processes
+  Args:
+    vectorfile: word embedding text file
+    vocabulary: dict/set of strings, or int specifying number of words to load; if None loads all words from file
+    dimension: number of dimensions to load
+    n_jobs: number of worker processes; if -1 uses all CPUs
+  Returns:
+    (list of words, numpy array of size (len(words), dimension))
+  '''
+
+  n_jobs = cpu_count() if n_jobs == -1 else n_jobs
+  with open(vectorfile, 'rb') as f:
+    if type(vocabulary) == int:
+      stop = 0
+      for i, line in zip(range(vocabulary), f):
+        stop += len(line)
       vocabulary = None
     else:
-      V = len(vocabulary)
-
-    with open(vectorfile, 'r') as f:
-      n = 0
-      for line in f:
-        index = line.index(' ')
-        word = line[:index]
-        if vocabulary is None or word in vocabulary:
-          yield word, np.array([FLOAT(entry) for entry in line[index+1:].split()[:dimension]])
+      stop = f.seek(0, 2)
+    offsets = [0]
+    for i in range(1, 4*n_jobs):
+      f.seek(max(offsets[-1], int(i/(4*n_jobs)*stop)))
+      f.readline()
+      offsets.append(min(f.tell(), stop))
+    offsets.append(stop)
+
+  ranges = [(vectorfile, start, end, vocabulary, dimension) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+  pool = Pool(n_jobs)
+  chunks = pool.map(parse_chunk, ranges)
+  pool.close()
+  pool.join()
+  words = [word for chunk, _ in chunks for word in chunk]
+  chunks = [vectors for _, vectors in chunks if vectors.shape[0]]
+  if not chunks:
+    return words, np.empty((0, 0 if dimension is None else dimension), dtype=FLOAT)
+  vectors = np.vstack(chunks)
+  if not vocabulary is None:
+    # duplicate words are resolved to their last occurrence, as in mmap_load, hdf5_load, and load with last=True
+    rows = sorted({word: i for i, word in enumerate(words)}.values())
+    if len(rows) < len(words):
+      return [words[i] for i in rows], vectors[rows]
+  return words, vectors
+
+
+def load_matrix(vectorfile, vocabulary=None, dimension=None, n_jobs=1, missing=None):
+  '''loads word embeddings from file as a list of words and a matrix
+  Args:
+    vectorfile: word embedding text file, HDF5 file with keys 'words' and 'vectors', or directory written by txt2mmap
+    vocabulary: dict/set of strings, or int specifying number of words to load; if None loads all words from file
+    dimension: number of dimensions to load
+    n_jobs: number of processes to use to parse text files; if -1 uses all CPUs
+    missing: set to which words in vocabulary that are not found in the file are added; ignored if None
+  Returns:
+    (list of words, numpy array of size (len(words), dimension))
+  '''
+
+  if os.path.isdir(vectorfile) or h5py.is_hdf5(vectorfile) or n_jobs != 1:
+    if os.path.isdir(vectorfile):
+      words, vectors = mmap_load(vectorfile, vocabulary, dimension)
+    elif h5py.is_hdf5(vectorfile):
+      words, vectors = hdf5_load(vectorfile, vocabulary, dimension)
+    else:
+      words, vectors = parallel_load(vectorfile, vocabulary, dimension, n_jobs)
+    if not (missing is None or vocabulary is None or type(vocabulary) == int):
+      missing.update(set(vocabulary).difference(words))
+    return words, vectors
+  words, vectors = [], []
+  for word, vector in load(vectorfile, vocabulary, dimension, missing=missing):
+    words.append(word)
+    vectors.append(vector)
+  if not vectors:
+    return words, np.empty((0, 0 if dimension is None else dimension), dtype=FLOAT)
+  return words, np.vstack(vectors)
+
+
+def cache_key(vectorfile, vocabulary=None, dimension=None, unit=True):
+  '''computes key identifying a subset of a word embedding file
+  Args:
+    vectorfile: word embedding file
+    vocabulary: iterable of strings, or int specifying number of words to load; if None loads all words
+    dimension: number of dimensions to load
+    unit: normalize embeddings
+  Returns:
+    hex string
+  '''
+
+  stat = os.stat(vectorfile)
+  if vocabulary is None or type(vocabulary) == int:
+    vocab = str(vocabulary)
+  else:
+    vocab = hashlib.sha1('\n'.join(sorted(vocabulary)).encode('utf-8')).hexdigest()
+  return hashlib.sha1(repr((os.path.abspath(vectorfile), stat.st_mtime, stat.st_size, dimension, bool(unit), vocab)).encode('utf-8')).hexdigest()
+
+
+def evict_cache(cachedir=None, cachesize=None):
+  '''deletes least recently used cache entries until the cache fits in the size cap
+  Args:
+    cachedir: cache directory; if None uses CACHEDIR
+    cachesize: maximum total size of cache entries in bytes; if None uses CACHESIZE
+  Returns:
+    None
+  '''
+
+  cachedir = CACHEDIR if cachedir is None else cachedir
+  cachesize = CACHESIZE if cachesize is None else cachesize
+  entries = []
+  for name in os.listdir(cachedir):
+    entry = os.path.join(cachedir, name)
+    if os.path.isdir(entry) and not name.startswith('tmp'):
+      entries.append((os.path.getmtime(entry), sum(os.path.getsize(os.path.join(entry, fname)) for fname in os.listdir(entry)), entry))
+  total = sum(size for _, size, _ in entries)
+  for _, size, entry in sorted(entries):
+    if total <= cachesize:
+      break
+    shutil.rmtree(entry, ignore_errors=True)
+    total -= size
+
+
+def cached_load(vectorfile, vocabulary=None, dimension=None, unit=True, n_jobs=1, missing=None, cachedir=None, cachesize=None):
+  '''loads word embeddings from file as a list of words and a matrix, storing the result in an on-disk cache keyed on the file and arguments
+  Args:
+    vectorfile: word embedding text file, HDF5 file, or directory written by txt2mmap
+    vocabulary: dict/set of strings, or int specifying number of words to load; if None loads all words from file
+    dimension: number of dimensions to load
+    unit: normalize embeddings
+    n_jobs: number of processes to use to parse text files on a cache miss; if -1 uses all CPUs
+    missing: set to which words in vocabulary that are not found in the file are added; ignored if None
+    cachedir: cache directory; if None uses CACHEDIR
+    cachesize: maximum total size of cache entries in bytes; least recently used entries are evicted first; if None uses CACHESIZE
+  Returns:
+    (list of words, numpy array of size (len(words), dimension)); on a cache hit the array is memory-mapped
+  '''
+
+  cachedir = CACHEDIR if cachedir is None else cachedir
+  entry = os.path.join(cachedir, cache_key(vectorfile, vocabulary, dimension, unit))
+  if os.path.isdir(entry):
+    os.utime(entry, None)
+    words, vectors = mmap_load(entry)
+    if not (missing is None or vocabulary is None or type(vocabulary) == int):
+      missing.update(set(vocabulary).difference(words))
+    return words, vectors
+
+  words, vectors = load_matrix(vectorfile, vocabulary, dimension, n_jobs, missing)
+  if unit and vectors.shape[0]:
+    vectors = normalize(vectors)
+  if not os.path.isdir(cachedir):
+    os.makedirs(cachedir)
+  tmpdir = tempfile.mkdtemp(dir=cachedir)
+  np.save(os.path.join(tmpdir, 'vectors.npy'), vectors.astype(FLOAT))
+  with open(os.path.join(tmpdir, 'words.txt'), 'w') as f:
+    f.write('\n'.join(words))
+  try:
+    os.rename(tmpdir, entry)
+  except OSError:
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  evict_cache(cachedir, cachesize)
+  return words, vectors
+
+
+# NOTE: Some files have 2d or 2d+2 numbers on each line, with the last d of them being meaningless; avoid loading them by setting dimension=d
+def load(vectorfile, vocabulary=None, dimension=None, n_jobs=1, missing=None, last=False):
+  '''generates word embeddings from file; if vocabulary is a dict/set each word is generated once and reading a text file stops as soon as all of them are found
+  Args:
+    vectorfile: word embedding text file, HDF5 file with keys 'words' and 'vectors', or directory written by txt2mmap
+    vocabulary: dict/set of strings, or int specifying number of words to load; if None loads all words from file
+    dimension: number of dimensions to load
+    n_jobs: number of processes to use to parse text files; if -1 uses all CPUs
+    missing: set to which words in vocabulary that are not found in the file are added; ignored if None
+    last: if vocabulary is a dict/set, resolve words repeated in a text file to their last occurrence, as the other loaders do, instead of their first; this reads the whole file
+  Returns:
+    (word, vector) generator
+  '''
+
+  if os.path.isdir(vectorfile) or h5py.is_hdf5(vectorfile) or n_jobs != 1:
+    for word, vector in zip(*load_matrix(vectorfile, vocabulary, dimension, n_jobs, missing)):
+      yield word, vector
+
+  else:
+    with open(vectorfile, 'rb') as f:
+
+      if vocabulary is None or type(vocabulary) == int:
+        V = float('inf') if vocabulary is None else vocabulary
+        n = 0
+        for line in f:
+          if n == V:
+            break
+          index = line.index(b' ')
+          yield line[:index].decode('utf-8'), np.fromstring(line[index+1:], dtype=FLOAT, sep=' ')[:dimension]
           n += 1
-        if n == V:
-          break
 
+      elif last:
+        # numbers are parsed only for the last occurrence of requested words
+        requested = {word.encode('utf-8'): word for word in vocabulary}
+        found = {}
+        for i, line in enumerate(f):
+          index = line.find(b' ')
+          word = requested.get(line[:index])
+          if not word is None:
+            found[word] = (i, line[index+1:])
+        for word, (i, numbers) in sorted(found.items(), key=lambda item: item[1][0]):
+          yield word, np.fromstring(numbers, dtype=FLOAT, sep=' ')[:dimension]
+        if not missing is None:
+          missing.update(word for word in requested.values() if not word in found)
+
+      else:
+        # only the word prefix of each line is compared; numbers are parsed only for requested words
+        remaining = {word.encode('utf-8'): word for word in vocabulary}
+        for line in f:
+          if not remaining:
+            break
+          index = line.find(b' ')
+          word = remaining.pop(line[:index], None)
+          if not word is None:
+            yield word, np.fromstring(line[index+1:], dtype=FLOAT, sep=' ')[:dimension]
+        if not missing is None:
+          missing.update(remaining.values())
+
+
+class QuantizedMatrix:
+  '''matrix stored as float16 or as int8 with one float32 scale per row; rows are dequantized to float32 on access
+  '''
+
+  def __init__(self, matrix, dtype='int8'):
+    '''initializes object
+    Args:
+      matrix: numpy array of size (n, d)
+      dtype: storage type ('float16' or 'int8')
+    Returns:
+      None
+    '''
+
+    matrix = np.asarray(matrix)
+    if dtype == 'float16':
+      self.codes = matrix.astype(np.float16)
+      self.scales = None
+    elif dtype == 'int8':
+      self.scales = (np.abs(matrix).max(1) / 127.0).astype(FLOAT) if matrix.shape[1] else np.ones(matrix.shape[0], dtype=FLOAT)
+      self.scales[self.scales == 0.0] = 1.0
+      self.codes = np.round(matrix / self.scales[:,None]).astype(np.int8)
+    else:
+      raise(NotImplementedError)
+    self.shape = matrix.shape
+    self.dtype = np.dtype(FLOAT)
+
+  def __len__(self):
+
+    return self.shape[0]
+
+  def __getitem__(self, rows):
+    '''dequantizes rows
+    Args:
+      rows: int, slice, or int array
+    Returns:
+      float32 numpy array
+    '''
+
+    if self.scales is None:
+      return self.codes[rows].astype(FLOAT)
+    codes = self.codes[rows]
+    if codes.ndim == 1:
+      return codes.astype(FLOAT) * self.scales[rows]
+    return codes.astype(FLOAT) * self.scales[rows][:,None]
+
+  def blocks(self, blocksize=BLOCKSIZE):
+    '''generates dequantized blocks of rows
+    Args:
+      blocksize: number of rows per block
+    Returns:
+      (start, stop, float32 numpy array of size (stop-start, d)) generator
+    '''
+
+    for start in range(0, self.shape[0], blocksize):
+      stop = min(start+blocksize, self.shape[0])
+      yield start, stop, self[start:stop]
+
+  def rdot(self, X, blocksize=BLOCKSIZE):
+    '''computes X.dot(self), dequantizing one block of rows at a time
+    Args:
+      X: numpy array or scipy sparse matrix of size (m, n)
+      blocksize: number of rows of self to dequantize at a time
+    Returns:
+      float32 numpy array of size (m, d)
+    '''
+
+    if sp.issparse(X):
+      X = X.tocsc()
+    output = np.zeros((X.shape[0], self.shape[1]), dtype=FLOAT)
+    for start, stop, block in self.blocks(blocksize):
+      output += X[:,start:stop].dot(block)
+    return output
+
+
+class ProductQuantizer:
+  '''product-quantization codec: splits vectors into contiguous subspaces and encodes each subvector as the uint8 index of its nearest centroid in a per-subspace codebook
+  '''
+
+  def __init__(self, subspaces=8, centroids=256, sample=100000, random_state=0):
+    '''initializes object
+    Args:
+      subspaces: number of subspaces (bytes per encoded vector)
+      centroids: number of centroids per codebook; at most 256
+      sample: maximum number of rows used to train the codebooks
+      random_state: seed for sampling and k-means
+    Returns:
+      None
+    '''
+
+    assert centroids <= 256, "codes are stored as uint8"
+    self.subspaces = subspaces
+    self.centroids = centroids
+    self.sample = sample
+    self.random_state = random_state
+
+  def fit(self, X):
+    '''trains one k-means codebook per subspace on a sample of rows
+    Args:
+      X: numpy array of size (n, d)
+    Returns:
+      self (with attribute bounds, a list of (start, stop) subspace column ranges, and codebooks, a list of float32 arrays of size (centroids, stop-start))
+    '''
+
+    rng = np.random.RandomState(self.random_state)
+    if X.shape[0] > self.sample:
+      X = X[np.sort(rng.choice(X.shape[0], self.sample, replace=False))]
+    X = np.asarray(X, dtype=FLOAT)
+    splits = np.linspace(0, X.shape[1], self.subspaces+1).astype(int)
+    self.bounds = list(zip(splits[:-1], splits[1:]))
+    k = min(self.centroids, X.shape[0])
+    self.codebooks = [KMeans(n_clusters=k, n_init=1, random_state=self.random_state).fit(X[:,start:stop]).cluster_centers_.astype(FLOAT) for start, stop in self.bounds]
+    return self
+
+  def encode(self, X, blocksize=BLOCKSIZE):
+    '''encodes rows as indices of their nearest centroids
+    Args:
+      X: numpy array of size (n, d)
+      blocksize: number of rows to encode at a time
+    Returns:
+      uint8 numpy array of size (n, subspaces)
+    '''
+
+    codes = np.empty((X.shape[0], len(self.bounds)), dtype=np.uint8)
+    for start in range(0, X.shape[0], blocksize):
+      block = np.asarray(X[start:start+blocksize], dtype=FLOAT)
+      for j, ((lo, hi), codebook) in enumerate(zip(self.bounds, self.codebooks)):
+        codes[start:start+blocksize,j] = np.argmin((codebook**2).sum(1) - 2.0*block[:,lo:hi].dot(codebook.T), axis=1)
+    return codes
+
+  def decode(self, codes):
+    '''reconstructs rows from their codes
+    Args:
+      codes: uint8 numpy array of size (n, subspaces) or (subspaces,)
+    Returns:
+      float32 numpy array of size (n, d) or (d,)
+    '''
+
+    return np.concatenate([codebook[codes[...,j]] for j, codebook in enumerate(self.codebooks)], axis=-1)
+
+  def tables(self, Q):
+    '''computes inner products between queries and every centroid, for asymmetric-distance computation
+    Args:
+      Q: numpy array of size (q, d)
+    Returns:
+      list of float32 numpy arrays of size (q, centroids), one per subspace
+    '''
+
+    return [np.asarray(Q[:,lo:hi], dtype=FLOAT).dot(codebook.T) for (lo, hi), codebook in zip(self.bounds, self.codebooks)]
+
+
+class PQMatrix(QuantizedMatrix):
+  '''matrix stored as product-quantization codes; rows are decoded to float32 on access and products with other matrices are computed from the codes
+  '''
+
+  def __init__(self, matrix, quantizer=None, **kwargs):
+    '''initializes object
+    Args:
+      matrix: numpy array of size (n, d)
+      quantizer: fitted ProductQuantizer; if None fits one on matrix
+      kwargs: passed to ProductQuantizer; ignored if not quantizer is None
+    Returns:
+      None
+    '''
+
+    self.quantizer = ProductQuantizer(**kwargs).fit(matrix) if quantizer is None else quantizer
+    self.codes = self.quantizer.encode(matrix)
+    self.scales = None
+    self.shape = matrix.shape
+    self.dtype = np.dtype(FLOAT)
+    self.norms = np.sqrt(sum((codebook**2).sum(1)[self.codes[:,j]] for j, codebook in enumerate(self.quantizer.codebooks)))
+
+  def __getitem__(self, rows):
+
+    return self.quantizer.decode(self.codes[rows])
+
+  def rdot(self, X, blocksize=BLOCKSIZE):
+    '''computes X.dot(self) by counting, for each subspace, how often each centroid occurs, without decoding any rows
+    Args:
+      X: numpy array or scipy sparse matrix of size (m, n)
+      blocksize: ignored
+    Returns:
+      float32 numpy array of size (m, d)
+    '''
+
+    n = self.shape[0]
+    output = np.empty((X.shape[0], self.shape[1]), dtype=FLOAT)
+    for j, ((lo, hi), codebook) in enumerate(zip(self.quantizer.bounds, self.quantizer.codebooks)):
+      onehot = sp.csr_matrix((np.ones(n, dtype=FLOAT), self.codes[:,j], np.arange(n+1)), shape=(n, codebook.shape[0]))
+      counts = X.dot(onehot) if sp.issparse(X) else onehot.T.dot(np.asarray(X).T).T
+      output[:,lo:hi] = counts.dot(codebook)
+    return output
+
+  def dot(self, Q):
+    '''computes self.dot(Q.T) from the codes using asymmetric-distance lookup tables
+    Args:
+      Q: numpy array of size (q, d) or (d,)
+    Returns:
+      float32 numpy array of size (n, q) or (n,)
+    '''
+
+    tables = self.quantizer.tables(np.atleast_2d(Q))
+    output = sum(table[:,self.codes[:,j]] for j, table in enumerate(tables)).T
+    return output[:,0] if Q.ndim == 1 else output
+
+  def cosine(self, Q):
+    '''computes cosine similarities between the (decoded) rows and the queries from the codes
+    Args:
+      Q: numpy array of size (q, d) or (d,)
+    Returns:
+      float32 numpy array of size (n, q) or (n,)
+    '''
+
+    qnorms = norm(np.atleast_2d(Q), axis=1)
+    denom = np.outer(self.norms, qnorms)
+    output = np.zeros(denom.shape, dtype=FLOAT)
+    np.divide(self.dot(np.atleast_2d(Q)), denom, out=output, where=denom>0.0)
+    return output[:,0] if Q.ndim == 1 else output
+
+
+def quantize_matrix(matrix, quantize):
+  '''compresses matrix
+  Args:
+    matrix: numpy array of size (n, d)
+    quantize: 'float16' or 'int8' for scalar quantization, or 'pq' or a fitted ProductQuantizer for product quantization
+  Returns:
+    QuantizedMatrix
+  '''
+
+  if isinstance(quantize, ProductQuantizer):
+    return PQMatrix(matrix, quantize)
+  if quantize == 'pq':
+    return PQMatrix(matrix)
+  return QuantizedMatrix(matrix, quantize)
+
+
+def hashed_random(words, random='gaussian', dimension=300, seed=0, blocksize=BLOCKSIZE):
+  '''generates random word vectors statelessly: entry j of the vector of a word is a counter-based pseudorandom function of (stable hash of the word and seed, j), so vectors are identical across processes and machines and need not be stored
+  Args:
+    words: list of strings
+    random: type ('Gaussian' or 'Rademacher') of random vectors; if tuple (low, high) uses uniform distribution over [low, high)
+    dimension: embedding dimension
+    seed: int mixed into each word hash
+    blocksize: number of words to generate at a time
+  Returns:
+    float32 numpy array of size (len(words), dimension)
+  '''
+
+  gaussian = type(random) != tuple and random.lower() == 'gaussian'
+  if not (gaussian or type(random) == tuple or random.lower() == 'rademacher'):
+    raise(NotImplementedError)
+  ncounters = 2*dimension if gaussian else dimension
+  weyl = np.arange(1, ncounters+1, dtype=np.uint64) * np.uint64(GOLDEN64)
+  salt = np.uint64(mix64((seed * GOLDEN64) & MASK64))
+  output = np.empty((len(words), dimension), dtype=FLOAT)
+  for start in range(0, len(words), blocksize):
+    keys = mix64(np.fromiter(map(word_hash, words[start:start+blocksize]), dtype=np.uint64) ^ salt)
+    uniform = ((mix64(keys[:,None] + weyl) >> np.uint64(11)) + np.uint64(1)).astype(np.float64) * 2.0**-53
+    if gaussian:
+      block = np.sqrt(-2.0*np.log(uniform[:,:dimension])) * np.cos(2.0*np.pi*uniform[:,dimension:]) / np.sqrt(dimension)
+    elif type(random) == tuple:
+      block = random[0] + (random[1]-random[0])*(1.0-uniform)
+    else:
+      block = (2.0*(uniform > 0.5)-1.0) / np.sqrt(dimension)
+    output[start:start+blocksize] = block
+  return output
+
+
+class HashedVectors:
+  '''dict-like word-to-vector map for an unbounded vocabulary of stateless hash-seeded random vectors (see hashed_random); vectors are generated on access and never stored
+  '''
+
+  def __init__(self, random='gaussian', dimension=300, seed=0, unit=True):
+    '''initializes object
+    Args:
+      random: type ('Gaussian' or 'Rademacher') of random vectors; if tuple (low, high) uses uniform distribution over [low, high)
+      dimension: embedding dimension
+      seed: int mixed into each word hash
+      unit: normalize embeddings; ignored for uniform vectors
+    Returns:
+      None
+    '''
+
+    self.random = random
+    self.dimension = dimension
+    self.seed = seed
+    self.unit = unit
+
+  def batch(self, words):
+    '''generates vectors of a list of words
+    Args:
+      words: list of strings
+    Returns:
+      float32 numpy array of size (len(words), dimension)
+    '''
 
-def vocab2mat(vocabulary=None, random=None, vectorfile=None, corpus='CC', objective='GloVe', dimension=300, unit=True):
+    matrix = hashed_random(words, self.random, self.dimension, self.seed)
+    if self.unit and type(self.random) != tuple and len(words):
+      return normalize(matrix)
+    return matrix
+
+  def __getitem__(self, word):
+
+    return self.batch([word])[0]
+
+  def get(self, word, default=None):
+
+    return self[word]
+
+  def __contains__(self, word):
+
+    return True
+
+
+def vocab2mat(vocabulary=None, random=None, vectorfile=None, corpus='CC', objective='GloVe', dimension=300, unit=True, n_jobs=1, missing=None, cache=False, quantize=None, seed=None):
   '''constructs matrix of word vectors
   Args:
     vocabulary: dict mapping strings to indices, or iterable of strings, or int specifying vocab size; if None loads all words in vectorfile
     random: type ('Gaussian' or 'Rademacher') of random vectors to use; if None uses pretrained vectors; if tuple (low, high) uses uniform distribution over [low, high)
-    vectorfile: word embedding text file; ignored if not random is None
+    vectorfile: word embedding text file, HDF5 file, or directory written by txt2mmap; ignored if not random is None
     corpus: corpus used to train embeddings; ignored if not random is None or not vectorfile is None
     objective: objective used to train embeddings; ignored if not random is None or not vectorfile is None
     dimension: embedding dimension
     unit: normalize embeddings
+    n_jobs: number of processes to use to parse text vectorfile; if -1 uses all CPUs
+    missing: set to which words in vocabulary that are not found in vectorfile are added; ignored if None
+    cache: serve vectors from the on-disk cache in CACHEDIR, adding them to it if not present
+    quantize: if 'float16', 'int8', 'pq', or a fitted ProductQuantizer returns a QuantizedMatrix compressed accordingly (see quantize_matrix)
+    seed: if not None random vectors are generated statelessly from a hash of each word and this seed (see hashed_random); ignored if random is None
   Returns:
     numpy matrix of size (len(vocabulary), dimension)
   '''
 
   assert random is None or not vocabulary is None, "needs vocabulary size information for random vectors"
+  assert random is None or seed is None or not type(vocabulary) == int, "needs word information for hash-seeded random vectors"
+
+  if not quantize is None:
+    return quantize_matrix(vocab2mat(vocabulary, random, vectorfile, corpus, objective, dimension, unit, n_jobs, missing, cache, seed=seed), quantize)
 
   if random is None:
 
@@ -74,13 +787,39 @@ def vocab2mat(vocabulary=None, random=None, vectorfile=None, corpus='CC', object
       vocabulary = sorted(vocabulary)
     if type(vocabulary) == list:
       vocabulary = {word: i for i, word in enumerate(vocabulary)}
-    if type(vocabulary) == dict:
+    if cache:
+      words, vectors = cached_load(vectorfile, vocabulary, dimension, unit, n_jobs, missing)
+      if type(vocabulary) == dict:
+        matrix = np.zeros((len(vocabulary), dimension), dtype=FLOAT)
+        matrix[[vocabulary[word] for word in words]] = vectors
+        return matrix
+      return vectors
+    if os.path.isdir(vectorfile) or h5py.is_hdf5(vectorfile) or n_jobs != 1:
+      words, vectors = load_matrix(vectorfile, vocabulary, dimension, n_jobs, missing)
+      if type(vocabulary) == dict:
+        matrix = np.zeros((len(vocabulary), dimension), dtype=FLOAT)
+        matrix[[vocabulary[word] for word in words]] = vectors
+      else:
+        matrix = vectors
+    elif type(vocabulary) == dict:
       matrix = np.zeros((len(vocabulary), dimension), dtype=FLOAT)
-      for word, vector in load(vectorfile, vocabulary, dimension):
+      for word, vector in load(vectorfile, vocabulary, dimension, missing=missing):
         matrix[vocabulary[word]] = vector
     else:
-      matrix = np.vstack(load(vectorfile, vocabulary, dimension))
+      matrix = np.vstack([vector for word, vector in load(vectorfile, vocabulary, dimension)])
   
+  elif not seed is None:
+
+    if type(vocabulary) == dict:
+      words = [None]*len(vocabulary)
+      for word, i in vocabulary.items():
+        words[i] = word
+    else:
+      words = sorted(vocabulary) if type(vocabulary) == set else list(vocabulary)
+    matrix = hashed_random(words, random, dimension, seed)
+    if type(random) == tuple or random.lower() == 'rademacher':
+      return matrix
+
   else:
 
     if not type(vocabulary) == int:
@@ -99,16 +838,21 @@ def vocab2mat(vocabulary=None, random=None, vectorfile=None, corpus='CC', object
   return matrix
 
 
-def vocab2vecs(vocabulary=None, random=None, vectorfile=None, corpus='CC', objective='GloVe', dimension=300, unit=True):
+def vocab2vecs(vocabulary=None, random=None, vectorfile=None, corpus='CC', objective='GloVe', dimension=300, unit=True, n_jobs=1, missing=None, cache=False, quantize=None, seed=None):
   '''constructs dict mapping words to vectors
   Args:
     vocabulary: iterable of strings, or int specifying vocab size; if None loads all words in vectorfile
     random: type ('Gaussian' or 'Rademacher') of random vectors to use; if None uses pretrained vectors
-    vectorfile: word embedding text file; ignored if not random is None
+    vectorfile: word embedding text file, HDF5 file, or directory written by txt2mmap; ignored if not random is None
     corpus: corpus used to train embeddings; ignored if not random is None or not vectorfile is None
     objective: objective used to train embeddings; ignored if not random is None or not vectorfile is None
     dimension: embedding dimension
     unit: normalize embeddings
+    n_jobs: number of processes to use to parse text vectorfile; if -1 uses all CPUs
+    missing: set to which words in vocabulary that are not found in vectorfile are added; ignored if None
+    cache: serve vectors from the on-disk cache in CACHEDIR, adding them to it if not present
+    quantize: if 'float16', 'int8', 'pq', or a fitted ProductQuantizer returns a ({word: index} dict, QuantizedMatrix) tuple compressed accordingly (see quantize_matrix) instead of a dict
+    seed: if not None random vectors are generated statelessly from a hash of each word and this seed (see hashed_random); ignored if random is None
   Returns:
     {word: vector} dict; words not in vectorfile are not included
   '''
@@ -118,39 +862,337 @@ def vocab2vecs(vocabulary=None, random=None, vectorfile=None, corpus='CC', objec
   if random is None:
     if vectorfile is None:
       vectorfile = VECTORFILES[(corpus, objective, dimension)]
-    if unit:
-      return {word: vector/norm(vector) for word, vector in load(vectorfile, vocabulary, dimension)}
-    return dict(load(vectorfile, vocabulary, dimension))
-  return dict(zip(vocabulary, vocab2mat(vocabulary, random=random, dimension=dimension, unit=unit)))
+    if cache:
+      words, vectors = cached_load(vectorfile, vocabulary, dimension, unit, n_jobs, missing)
+    elif not quantize is None or os.path.isdir(vectorfile) or h5py.is_hdf5(vectorfile) or n_jobs != 1:
+      words, vectors = load_matrix(vectorfile, vocabulary, dimension, n_jobs, missing)
+      if unit:
+        vectors = vectors / norm(vectors, axis=1)[:,None]
+    elif unit:
+      return {word: vector/norm(vector) for word, vector in load(vectorfile, vocabulary, dimension, missing=missing)}
+    else:
+      return dict(load(vectorfile, vocabulary, dimension, missing=missing))
+  else:
+    words = list(vocabulary)
+    vectors = vocab2mat(words, random=random, dimension=dimension, unit=unit, seed=seed)
+
+  if quantize is None:
+    return dict(zip(words, vectors))
+  return {word: i for i, word in enumerate(words)}, quantize_matrix(vectors, quantize)
+
+
+def feature_matrix(f2v):
+  '''converts dict mapping features to vectors to a feature index and a matrix
+  Args:
+    f2v: dict mapping features to vectors, or tuple (dict mapping features to indices, matrix), which is returned as-is
+  Returns:
+    (dict mapping features to indices, matrix whose rows are the feature vectors)
+  '''
+
+  if type(f2v) == dict:
+    dimensions = {v.shape for v in f2v.values()}
+    assert len(dimensions) == 1, "all feature vectors must have same dimension"
+    return {feat: i for i, feat in enumerate(f2v)}, np.vstack(list(f2v.values()))
+  return f2v
+
+
+def feature_weights(vocabulary, weights, default=1.0, dtype=FLOAT):
+  '''converts dict mapping features to weights to a weight vector
+  Args:
+    vocabulary: dict mapping features to indices
+    weights: dict mapping features to weights, or list/np.ndarray of weights indexed like vocabulary, which is returned as an array
+    default: default weight to assign if feature not in weights
+    dtype: weight vector dtype
+  Returns:
+    numpy vector of size len(vocabulary)
+  '''
+
+  if type(weights) == dict:
+    diag = np.empty(len(vocabulary), dtype=dtype)
+    for feat, i in vocabulary.items():
+      diag[i] = weights.get(feat, default)
+    return diag
+  assert len(weights) == len(vocabulary), "if weights passed as a list/np.ndarray, length must be same as vocabulary size"
+  return np.asarray(weights, dtype=dtype)
 
 
 def docs2vecs(documents, f2v=None, weights=None, default=1.0, avg=False, **kwargs):
-  '''computes document embeddings from documents
+  '''computes document embeddings from documents as one sparse-dense matrix product
   Args:
-    documents: iterable of lists of hashable features
-    f2v: dict mapping features to vectors; if None will compute this using vocab2vecs
-    weights: dict mapping features to weights; unweighted if None
+    documents: iterable of lists of hashable features or Corpus
+    f2v: dict mapping features to vectors, or tuple (dict mapping features to indices, matrix or QuantizedMatrix whose rows are the feature vectors); if None will compute this using vocab2mat
+    weights: dict mapping features to weights, or list/np.ndarray of weights indexed like the rows of the matrix in f2v; unweighted if None
     default: default weight to assign if feature not in weights; ignored if weights is None
     avg: divide embeddings by the document length
-    kwargs: passed to vocab2vecs; ignored if not f2v is None
+    kwargs: passed to vocab2mat; ignored if not f2v is None
   Returns:
     matrix of size (len(documents), dimension)
   '''
 
+  corpus = isinstance(documents, Corpus)
+  if not corpus and not type(documents) == list:
+    documents = list(documents)
   if f2v is None:
-    f2v = vocab2vecs({word for document in documents for word in documents}, **kwargs)
-    dimension = kwargs.get('dimension', 300)
+    if corpus:
+      vocabulary = {feat: i for i, feat in enumerate(sorted(documents.words[i] for i in np.flatnonzero(documents.counts())))}
+    else:
+      vocabulary = {feat: i for i, feat in enumerate(sorted({feat for document in documents for feat in document}))}
+    matrix = vocab2mat(vocabulary, **kwargs)
   else:
-    dimensions = {v.shape for v in f2v.values()}
-    assert len(dimensions) == 1, "all feature vectors must have same dimension"
-    dimension = dimensions.pop()
-  if not weights is None:
-    f2v = {feat: weights.get(feat, default)*vec for feat, vec in f2v.items()}
-    
-  z = np.zeros(dimension, dtype=FLOAT)
+    vocabulary, matrix = feature_matrix(f2v)
+
+  # features not in the vocabulary are dropped from the document-by-feature count matrix but still count toward the document length
+  if corpus:
+    ids = documents.lookup(vocabulary)[documents.ids]
+    lengths = documents.lengths()
+  else:
+    ids = np.fromiter((vocabulary.get(feat, -1) for document in documents for feat in document), dtype=np.int64)
+    lengths = np.fromiter((len(document) for document in documents), dtype=np.int64, count=len(documents))
+  known = ids >= 0
+  indptr = np.concatenate([[0], np.cumsum(known)])[np.concatenate([[0], np.cumsum(lengths)])]
+  indices = ids[known]
+  if weights is None:
+    data = np.ones(indices.shape[0], dtype=matrix.dtype)
+  else:
+    data = feature_weights(vocabulary, weights, default, matrix.dtype)[indices]
+
+  bofs = sp.csr_matrix((data, indices, indptr), shape=(len(documents), matrix.shape[0]))
+  output = matrix.rdot(bofs) if isinstance(matrix, QuantizedMatrix) else bofs.dot(matrix)
   if avg:
-    return np.vstack(sum((f2v.get(feat, z) for feat in document), z) / max(1.0, len(document)) for document in documents)
-  return np.vstack(sum((f2v.get(feat, z) for feat in document), z) for document in documents)
+    output /= np.maximum(1, lengths)[:,None]
+  return output
+
+
+def stream_docs2vecs(documents, output, f2v, weights=None, default=1.0, avg=False, batchsize=10000):
+  '''computes document embeddings from a stream of documents one block at a time, writing each block into a preallocated array so that memory use does not depend on the number of documents
+  Args:
+    documents: iterable (e.g. generator) of lists of hashable features
+    output: array-like of size (number of documents, dimension) supporting slice assignment, e.g. np.memmap from np.lib.format.open_memmap or h5py dataset; h5py datasets created with maxshape=(None, dimension) are resized as needed
+    f2v: dict mapping features to vectors, or tuple (dict mapping features to indices, matrix or QuantizedMatrix whose rows are the feature vectors)
+    weights: dict mapping features to weights, or list/np.ndarray of weights indexed like the rows of the matrix in f2v; unweighted if None
+    default: default weight to assign if feature not in weights; ignored if weights is None
+    avg: divide embeddings by the document length
+    batchsize: number of documents to process at a time
+  Returns:
+    generator of the number of documents written so far, one value per block
+  '''
+
+  vocabulary, matrix = feature_matrix(f2v)
+  if not weights is None:
+    weights = feature_weights(vocabulary, weights, default, matrix.dtype)
+  documents = iter(documents)
+  offset = 0
+  while True:
+    block = list(islice(documents, batchsize))
+    if not block:
+      break
+    if isinstance(output, h5py.Dataset) and output.shape[0] < offset+len(block):
+      output.resize(offset+len(block), axis=0)
+    output[offset:offset+len(block)] = docs2vecs(block, f2v=(vocabulary, matrix), weights=weights, default=default, avg=avg)
+    offset += len(block)
+    yield offset
+  if hasattr(output, 'flush'):
+    output.flush()
+
+
+def row_norms(matrix, blocksize=BLOCKSIZE):
+  '''computes Euclidean norms of the rows of a matrix one block at a time
+  Args:
+    matrix: numpy array (float32 or float16) or QuantizedMatrix of size (n, d)
+    blocksize: number of rows per block
+  Returns:
+    float32 numpy array of size n
+  '''
+
+  if isinstance(matrix, PQMatrix):
+    return matrix.norms
+  return np.concatenate([norm(np.asarray(matrix[start:start+blocksize], dtype=FLOAT), axis=1) for start in range(0, matrix.shape[0], blocksize)]) if matrix.shape[0] else np.zeros(0, dtype=FLOAT)
+
+
+def topk_cosine(queries, matrix, k=10, blocksize=BLOCKSIZE, n_jobs=1, norms=None):
+  '''finds the rows of a matrix with highest cosine similarity to each query, using blocked matrix-matrix products so that memory use is bounded by the block size
+  Args:
+    queries: numpy array of size (q, d) or (d,)
+    matrix: numpy array (float32 or float16, possibly memory-mapped) or QuantizedMatrix of size (n, d), e.g. output of vocab2mat or docs2vecs
+    k: number of neighbors to return per query
+    blocksize: number of rows of matrix to score at a time
+    n_jobs: number of threads scoring blocks in parallel; if -1 uses all CPUs
+    norms: row norms of matrix as returned by row_norms; if None computes them (pass them to avoid recomputing over repeated searches)
+  Returns:
+    (int numpy array of row indices, float32 numpy array of cosine similarities), each of size (q, k) or (k,) and sorted by decreasing similarity
+  '''
+
+  single = queries.ndim == 1
+  queries = normalize(np.atleast_2d(np.asarray(queries, dtype=FLOAT)))
+  if norms is None:
+    norms = row_norms(matrix, blocksize)
+  inverse = np.zeros(norms.shape, dtype=FLOAT)
+  np.divide(1.0, norms, out=inverse, where=norms>0.0)
+  n = matrix.shape[0]
+  k = min(k, n)
+
+  def search(start):
+    stop = min(start+blocksize, n)
+    scores = queries.dot(np.asarray(matrix[start:stop], dtype=FLOAT).T) * inverse[start:stop]
+    if stop-start > k:
+      candidates = np.argpartition(-scores, k-1, axis=1)[:,:k]
+    else:
+      candidates = np.tile(np.arange(stop-start), (scores.shape[0], 1))
+    return candidates+start, np.take_along_axis(scores, candidates, axis=1)
+
+  starts = range(0, n, blocksize)
+  if n_jobs == 1:
+    results = [search(start) for start in starts]
+  else:
+    pool = ThreadPool(cpu_count() if n_jobs == -1 else n_jobs)
+    results = pool.map(search, starts)
+    pool.close()
+    pool.join()
+  indices = np.hstack([result[0] for result in results])
+  scores = np.hstack([result[1] for result in results])
+  order = np.argsort(-scores, axis=1, kind='stable')[:,:k]
+  indices, scores = np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+  if single:
+    return indices[0], scores[0]
+  return indices, scores
+
+
+def nearest_words(words, w2v, k=10, **kwargs):
+  '''finds the nearest neighbors of words by cosine similarity
+  Args:
+    words: list of strings in w2v
+    w2v: dict mapping words to vectors, or tuple (dict mapping words to indices, matrix or QuantizedMatrix)
+    k: number of neighbors to return per word (including the word itself)
+    kwargs: passed to topk_cosine
+  Returns:
+    list of lists of (word, cosine similarity) tuples
+  '''
+
+  vocabulary, matrix = feature_matrix(w2v)
+  index2word = {i: word for word, i in vocabulary.items()}
+  indices, scores = topk_cosine(np.atleast_2d(matrix[[vocabulary[word] for word in words]]), matrix, k=k, **kwargs)
+  return [[(index2word[i], score) for i, score in zip(row, rowscores)] for row, rowscores in zip(indices, scores)]
+
+
+class IVFIndex:
+  '''approximate cosine-similarity index: rows are normalized and stored grouped by their nearest k-means centroid (inverted lists), and queries only score the rows in the lists of their nearest centroids
+  '''
+
+  def __init__(self, lists=1024, probes=8, sample=100000, random_state=0):
+    '''initializes object
+    Args:
+      lists: number of k-means centroids (inverted lists)
+      probes: default number of lists to search per query
+      sample: maximum number of rows used to train the centroids
+      random_state: seed for sampling and k-means
+    Returns:
+      None
+    '''
+
+    self.lists = lists
+    self.probes = probes
+    self.sample = sample
+    self.random_state = random_state
+
+  def build(self, matrix, blocksize=BLOCKSIZE):
+    '''builds index
+    Args:
+      matrix: numpy array (possibly memory-mapped) or QuantizedMatrix of size (n, d), e.g. output of vocab2mat
+      blocksize: number of rows to assign to lists at a time
+    Returns:
+      self (with attributes centroids, offsets, ids, and vectors; rows ids[offsets[i]:offsets[i+1]] of matrix are in list i and their normalized vectors are vectors[offsets[i]:offsets[i+1]])
+    '''
+
+    n = matrix.shape[0]
+    rng = np.random.RandomState(self.random_state)
+    sample = np.sort(rng.choice(n, self.sample, replace=False)) if n > self.sample else np.arange(n)
+    lists = min(self.lists, sample.shape[0])
+    kmeans = MiniBatchKMeans(n_clusters=lists, n_init=1, random_state=self.random_state)
+    self.centroids = normalize(kmeans.fit(normalize(np.asarray(matrix[sample], dtype=FLOAT))).cluster_centers_).astype(FLOAT)
+
+    assignment = np.empty(n, dtype=np.int64)
+    for start in range(0, n, blocksize):
+      assignment[start:start+blocksize] = np.argmax(normalize(np.asarray(matrix[start:start+blocksize], dtype=FLOAT)).dot(self.centroids.T), axis=1)
+    self.ids = np.argsort(assignment, kind='stable')
+    self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=lists))])
+    self.vectors = np.empty((n, matrix.shape[1]), dtype=FLOAT)
+    for start in range(0, n, blocksize):
+      rows = self.ids[start:start+blocksize]
+      self.vectors[start:start+blocksize] = normalize(np.asarray(matrix[np.sort(rows)], dtype=FLOAT))[np.argsort(np.argsort(rows))]
+    return self
+
+  def save(self, indexdir):
+    '''writes index to a directory
+    Args:
+      indexdir: output directory
+    Returns:
+      None
+    '''
+
+    if not os.path.isdir(indexdir):
+      os.makedirs(indexdir)
+    for name in ['centroids', 'offsets', 'ids', 'vectors']:
+      np.save(os.path.join(indexdir, name+'.npy'), getattr(self, name))
+
+  @classmethod
+  def load(cls, indexdir, probes=8):
+    '''loads index written by save, memory-mapping the row ids and vectors
+    Args:
+      indexdir: directory written by save
+      probes: default number of lists to search per query
+    Returns:
+      IVFIndex
+    '''
+
+    index = cls(probes=probes)
+    for name in ['centroids', 'offsets']:
+      setattr(index, name, np.load(os.path.join(indexdir, name+'.npy')))
+    for name in ['ids', 'vectors']:
+      setattr(index, name, np.load(os.path.join(indexdir, name+'.npy'), mmap_mode='r'))
+    index.lists = index.centroids.shape[0]
+    return index
+
+  def query(self, queries, k=10, probes=None):
+    '''finds approximate nearest neighbors by cosine similarity
+    Args:
+      queries: numpy array of size (q, d) or (d,)
+      k: number of neighbors to return per query
+      probes: number of lists to search per query; if None uses self.probes
+    Returns:
+      (int numpy array of row indices, float32 numpy array of cosine similarities), each of size (q, k) or (k,) and sorted by decreasing similarity; padded with -1 and -inf if fewer than k rows are searched
+    '''
+
+    single = queries.ndim == 1
+    queries = normalize(np.atleast_2d(np.asarray(queries, dtype=FLOAT)))
+    probes = min(self.probes if probes is None else probes, self.centroids.shape[0])
+    nearest = np.argpartition(-queries.dot(self.centroids.T), probes-1, axis=1)[:,:probes]
+    indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+    scores = np.full((queries.shape[0], k), -np.inf, dtype=FLOAT)
+    for i, (query, lists) in enumerate(zip(queries, nearest)):
+      rows = np.concatenate([np.arange(self.offsets[j], self.offsets[j+1]) for j in lists])
+      candidates = np.concatenate([self.vectors[self.offsets[j]:self.offsets[j+1]] for j in lists]).dot(query)
+      top = np.argsort(-candidates, kind='stable')[:k]
+      indices[i,:top.shape[0]] = self.ids[rows[top]]
+      scores[i,:top.shape[0]] = candidates[top]
+    if single:
+      return indices[0], scores[0]
+    return indices, scores
+
+  def recall(self, queries, matrix, k=10, probes=None, **kwargs):
+    '''measures the fraction of the exact top-k neighbors that the index returns
+    Args:
+      queries: numpy array of size (q, d)
+      matrix: matrix the index was built from
+      k: number of neighbors per query
+      probes: number of lists to search per query; if None uses self.probes
+      kwargs: passed to topk_cosine
+    Returns:
+      recall as a float
+    '''
+
+    exact = topk_cosine(queries, matrix, k=k, **kwargs)[0]
+    approximate = self.query(queries, k=k, probes=probes)[0]
+    return np.mean([len(set(e).intersection(a)) / float(len(e)) for e, a in zip(np.atleast_2d(exact), np.atleast_2d(approximate))])
 
 
 class OrthogonalProcrustes:
@@ -188,35 +1230,210 @@ class OrthogonalProcrustes:
     return self
 
 
+class DictRows:
+  '''read-only matrix view whose rows are the vectors of a list of words in a word-to-vector dict; rows are only stacked when sliced
+  '''
+
+  def __init__(self, w2v, words):
+    '''initializes object
+    Args:
+      w2v: dict mapping words to vectors
+      words: list of words in w2v
+    Returns:
+      None
+    '''
+
+    self.w2v = w2v
+    self.words = words
+    vector = np.asarray(w2v[words[0]]) if words else np.zeros(0, dtype=FLOAT)
+    self.shape = (len(words), vector.shape[0])
+    self.dtype = vector.dtype
+
+  def __len__(self):
+
+    return self.shape[0]
+
+  def __getitem__(self, rows):
+
+    if type(rows) == slice:
+      words = self.words[rows]
+      return np.vstack([self.w2v[w] for w in words]) if words else np.zeros((0, self.shape[1]), dtype=self.dtype)
+    return np.asarray(self.w2v[self.words[rows]])
+
+
+class IndexedRows:
+  '''read-only matrix view whose rows are rows of another matrix at given indices; rows are only gathered when sliced
+  '''
+
+  def __init__(self, matrix, index):
+    '''initializes object
+    Args:
+      matrix: numpy array (possibly memory-mapped) or QuantizedMatrix
+      index: int numpy array of row indices
+    Returns:
+      None
+    '''
+
+    self.matrix = matrix
+    self.index = index
+    self.shape = (index.shape[0], matrix.shape[1])
+    self.dtype = matrix.dtype
+
+  def __len__(self):
+
+    return self.shape[0]
+
+  def __getitem__(self, rows):
+
+    return self.matrix[self.index[rows]]
+
+
+class AlignedPair:
+  '''two word embeddings restricted to their shared vocabulary; the shared words and their row indices in each embedding are computed once so that the aligned matrices can be reused across best_transform, average_cosine_similarity, and repeated calls with different settings
+  '''
+
+  def __init__(self, X, Y):
+    '''initializes object
+    Args:
+      X: dict mapping words to vectors, or tuple (dict mapping words to indices, matrix or QuantizedMatrix) as returned by vocab2vecs(quantize=...)
+      Y: dict mapping words to vectors, or tuple (dict mapping words to indices, matrix or QuantizedMatrix)
+    Returns:
+      None (sets attribute words, the sorted shared vocabulary)
+    '''
+
+    stores = [X, Y]
+    self.words = sorted(set(X[0] if type(X) == tuple else X).intersection(Y[0] if type(Y) == tuple else Y))
+    self._views = []
+    for store in stores:
+      if type(store) == tuple:
+        vocabulary, matrix = store
+        self._views.append(IndexedRows(matrix, np.array([vocabulary[w] for w in self.words], dtype=np.int64)))
+      else:
+        self._views.append(DictRows(store, self.words))
+    self._matrices = [None, None]
+
+  def _matrix(self, i):
+
+    if self._matrices[i] is None:
+      self._matrices[i] = self._views[i][:]
+    return self._matrices[i]
+
+  @property
+  def source(self):
+    '''aligned rows of X as a numpy array, gathered on first access
+    '''
+
+    return self._matrix(0)
+
+  @property
+  def target(self):
+    '''aligned rows of Y as a numpy array, gathered on first access
+    '''
+
+    return self._matrix(1)
+
+  def views(self):
+    '''returns lazy views of the aligned rows of X and Y that are gathered one slice at a time
+    '''
+
+    return tuple(self._views)
+
+  def __iter__(self):
+
+    yield self.source
+    yield self.target
+
+
 def align_vocab(func):
-  '''wrapper to align vocab to allow word-to-vector dict inputs to functions taking two word-vector matrices as inputs
+  '''wrapper to align vocab to allow word-to-vector dict or (word-to-index dict, matrix) tuple inputs to functions taking two word-vector matrices as inputs; if called with chunked=True the aligned rows are gathered one block at a time instead of up front
   '''
 
   def wrapper(X, Y, **kwargs):
-    assert type(X) == type(Y), "first two arguments must be the same type"
-    if type(X) == dict:
-      vocab = sorted(set(X.keys()).intersection(Y.keys()))
-      X = np.vstack(X[w] for w in vocab)
-      Y = np.vstack(Y[w] for w in vocab)
+    keyed = [type(M) in {dict, tuple} for M in [X, Y]]
+    assert keyed[0] == keyed[1], "first two arguments must both be word-keyed ('dict' or 'tuple') or both be matrices"
+    if keyed[0]:
+      pair = AlignedPair(X, Y)
+      X, Y = pair.views() if kwargs.get('chunked', False) else tuple(pair)
     else:
-      assert type(X) == np.ndarray, "first two arguments must be 'dict' or 'numpy.ndarray'"
+      assert all(isinstance(M, (np.ndarray, QuantizedMatrix)) for M in [X, Y]), "first two arguments must be 'dict', 'tuple', 'numpy.ndarray', or 'QuantizedMatrix'"
     return func(X, Y, **kwargs)
 
   return wrapper
 
 
+def row_blocks(X, blocksize=BLOCKSIZE):
+  '''generates blocks of rows of a matrix, dequantizing them if necessary
+  Args:
+    X: numpy array, QuantizedMatrix, DictRows, or IndexedRows
+    blocksize: number of rows per block
+  Returns:
+    (start, stop, numpy array of size (stop-start, d)) generator
+  '''
+
+  if isinstance(X, QuantizedMatrix):
+    for block in X.blocks(blocksize):
+      yield block
+  else:
+    for start in range(0, X.shape[0], blocksize):
+      yield start, min(start+blocksize, X.shape[0]), X[start:start+blocksize]
+
+
+def blocked_transform(source, target, orthogonal=True, fit_intercept=False, blocksize=BLOCKSIZE):
+  '''computes best_transform from float64 sums and cross-products accumulated one block of rows at a time, so that only O(dimension^2) memory is needed beyond one block
+  Args:
+    source: numpy array (possibly memory-mapped), QuantizedMatrix, DictRows, or IndexedRows of size (len(vocabulary), dimension)
+    target: numpy array (possibly memory-mapped), QuantizedMatrix, DictRows, or IndexedRows of size (len(vocabulary), dimension)
+    orthogonal: if True constrains best transform to be orthogonal
+    fit_intercept: whether to find best transformation after translation
+    blocksize: number of rows per block
+  Returns:
+    numpy array of size (dimension, dimension), numpy array of size dimension
+  '''
+
+  n = source.shape[0]
+  sx, sy = np.zeros(source.shape[1]), np.zeros(target.shape[1])
+  XTY = np.zeros((source.shape[1], target.shape[1]))
+  XTX = None if orthogonal else np.zeros((source.shape[1], source.shape[1]))
+  for (start, stop, X), (_, _, Y) in zip(row_blocks(source, blocksize), row_blocks(target, blocksize)):
+    X, Y = X.astype(np.float64), Y.astype(np.float64)
+    sx += X.sum(0)
+    sy += Y.sum(0)
+    XTY += X.T.dot(Y)
+    if not orthogonal:
+      XTX += X.T.dot(X)
+
+  if fit_intercept:
+    XTY -= np.outer(sx, sy) / n
+    if not orthogonal:
+      XTX -= np.outer(sx, sx) / n
+  if orthogonal:
+    U, _, VT = svd(XTY.T)
+    coef = U.dot(VT)
+  else:
+    coef = lstsq(XTX, XTY)[0].T
+  if fit_intercept:
+    intercept = sy/n - coef.dot(sx/n)
+  else:
+    intercept = np.zeros(coef.shape[0])
+  return coef, intercept
+
+
 @align_vocab
-def best_transform(source, target, orthogonal=True, fit_intercept=False):
-  '''computes best matrix between two sets of word embeddings in terms of least-squares error
+def best_transform(source, target, orthogonal=True, fit_intercept=False, chunked=False):
+  '''computes best matrix between two sets of word embeddings in terms of least-squares error; to align the same embeddings repeatedly call best_transform(*AlignedPair(source, target), ...)
   Args:
-    source: numpy array of size (len(vocabulary), dimension) or dict mapping words to vectors; must be same type as target
-    target: numpy array of size (len(vocabulary), dimension) or dict mapping words to vectors; must be same type as source
+    source: numpy array or QuantizedMatrix of size (len(vocabulary), dimension) or dict mapping words to vectors or tuple (dict mapping words to indices, matrix); must be a dict/tuple iff target is
+    target: numpy array or QuantizedMatrix of size (len(vocabulary), dimension) or dict mapping words to vectors or tuple (dict mapping words to indices, matrix); must be a dict/tuple iff source is
     orthogonal: if True constrains best transform to be orthogonal
     fit_intercept: whether to find best transformation after translation
+    chunked: accumulate the dimension x dimension cross-covariance (and Gram matrix if not orthogonal) over blocks of the shared vocabulary instead of fitting on full aligned matrices; always used for QuantizedMatrix inputs
   Returns:
     numpy array of size (dimension, dimension)
   '''
 
+  if chunked or isinstance(source, QuantizedMatrix) or isinstance(target, QuantizedMatrix):
+    coef, intercept = blocked_transform(source, target, orthogonal=orthogonal, fit_intercept=fit_intercept)
+    return coef.astype(target.dtype), intercept.astype(target.dtype)
   if orthogonal:
     transform = OrthogonalProcrustes(fit_intercept=fit_intercept).fit(source, target)
   else:
@@ -227,13 +1444,16 @@ def best_transform(source, target, orthogonal=True, fit_intercept=False):
 
 
 @align_vocab
-def average_cosine_similarity(X, Y):
+def average_cosine_similarity(X, Y, chunked=False):
   '''computes the average cosine similarity between two sets of word embeddings
   Args:
-    X: numpy array of size (len(vocabulary), dimension) or dict mapping words to vectors; must be same type as target
-    Y: numpy array of size (len(vocabulary), dimension) or dict mapping words to vectors; must be same type as source
+    X: numpy array or QuantizedMatrix of size (len(vocabulary), dimension) or dict mapping words to vectors or tuple (dict mapping words to indices, matrix); must be a dict/tuple iff Y is
+    Y: numpy array or QuantizedMatrix of size (len(vocabulary), dimension) or dict mapping words to vectors or tuple (dict mapping words to indices, matrix); must be a dict/tuple iff X is
+    chunked: normalize and compare one block of rows at a time; always used for QuantizedMatrix inputs
   Returns:
     average cosine similarity as a float
   '''
 
+  if chunked or isinstance(X, QuantizedMatrix) or isinstance(Y, QuantizedMatrix):
+    return sum((normalize(Xb) * normalize(Yb)).sum() for (_, _, Xb), (_, _, Yb) in zip(row_blocks(X), row_blocks(Y))) / X.shape[0]
   return np.mean((normalize(X) * normalize(Y)).sum(1))